@@ -1,23 +1,28 @@
 import os
 import uvicorn
 import asyncio
-import time
+import orjson
+import hashlib
 from contextlib import asynccontextmanager
-from typing import Optional, List
+from dataclasses import replace
+from typing import Optional, List, Dict, Any
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # 导入你现有的模块
 from .services.petkit_service import PetKitService
 from .services.cloudpets_service import cloudpets_service, FeedingPlan as CloudPetsPlan
 from .models.models import User, WeightRecord, FeedingPlan, KnownDevice
-from .models.db import get_session, init_db
+from .models.db import get_session, get_engine, init_db, dialect_insert, db_now_ms, bulk_insert, get_settings
 from .utils.cache_manager import async_cache_manager
 from .scheduler.task_scheduler import scheduler, create_data_refresh_task
 
@@ -35,18 +40,23 @@ state = AppState()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """管理应用启动和关闭时的逻辑"""
-    # 启动时：初始化数据库和长连接服务
-    init_db()
+    # Python 3.12+: 新任务立即同步执行到第一个 await，已有连接的短请求无需再经过一次调度
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
 
-    # 初始化 CloudPets 服务 (从数据库加载 Token 或自动登录)
-    await cloudpets_service.initialize()
+    # 启动时：初始化数据库和长连接服务
+    await init_db()
 
     # 统一环境变量 ACCOUNT 和 PASSWORD
     # 注意：PetKit 通常需要带区号 (如 86-)，而 CloudPets 会自动去除
-    username = os.getenv("ACCOUNT")
-    password = os.getenv("PASSWORD")
-
-    if username and password:
+    settings = get_settings()
+    username = settings["account"]
+    password = settings["password"]
+
+    async def init_petkit():
+        if not (username and password):
+            print("警告: 未检测到 PETKIT 环境变量，相关 API 将不可用")
+            return
         print(f"正在初始化 PetKit 服务: {username}...")
         state.petkit = PetKitService(username, password)
         try:
@@ -54,9 +64,17 @@ async def lifespan(app: FastAPI):
             print("PetKit 服务连接成功")
         except Exception as e:
             print(f"PetKit 连接失败: {e}")
-    else:
-        print("警告: 未检测到 PETKIT 环境变量，相关 API 将不可用")
-    
+
+    async def init_cloudpets():
+        # 数据库或 CloudPets 不可用时不阻止应用启动，首次请求时再懒登录
+        try:
+            await cloudpets_service.initialize()
+        except Exception as e:
+            print(f"CloudPets 初始化失败，将在首次请求时重试登录: {e}")
+
+    # CloudPets (从数据库加载 Token 或自动登录) 与 PetKit 互不依赖，并发初始化
+    await asyncio.gather(init_cloudpets(), init_petkit())
+
     # 初始化数据刷新任务
     state.data_refresh_task = create_data_refresh_task(
         state.petkit, 
@@ -64,36 +82,27 @@ async def lifespan(app: FastAPI):
         async_cache_manager
     )
     
-    # 添加定时任务
-    await scheduler.add_task(
-        'dashboard_refresh', 
-        state.data_refresh_task.refresh_combined_dashboard_data,
-        interval=60,  # 每分钟刷新一次
-        immediate=True
-    )
-    
-    await scheduler.add_task(
-        'petkit_refresh',
-        state.data_refresh_task.refresh_petkit_data,
-        interval=180,  # 每3分钟刷新PetKit数据
-        immediate=False
-    )
-    
-    await scheduler.add_task(
-        'cloudpets_refresh',
-        state.data_refresh_task.refresh_cloudpets_data,
-        interval=120,  # 每2分钟刷新CloudPets数据
-        immediate=False
-    )
+    # 添加定时任务: (名称, 函数, 间隔秒数, 是否立即执行)
+    tasks = [
+        ('dashboard_refresh', state.data_refresh_task.refresh_combined_dashboard_data, 60, True),  # 每分钟刷新一次
+        ('petkit_refresh', state.data_refresh_task.refresh_petkit_data, 180, False),  # 每3分钟刷新PetKit数据
+        ('cloudpets_refresh', state.data_refresh_task.refresh_cloudpets_data, 120, False),  # 每2分钟刷新CloudPets数据
+    ]
+    await asyncio.gather(*[
+        scheduler.add_task(name, func, interval=interval, immediate=immediate)
+        for name, func, interval, immediate in tasks
+    ])
     
-    # 启动调度器
+    # 启动调度器和缓存过期清理任务
     await scheduler.start()
+    async_cache_manager.start_sweeper()
 
     yield  # 分隔符，上方是启动逻辑，下方是关闭逻辑
 
     # 关闭时：清理资源
     print("正在关闭调度器...")
     await scheduler.stop()
+    await async_cache_manager.stop_sweeper()
     
     if state.petkit:
         print("正在关闭 PetKit 服务...")
@@ -105,7 +114,9 @@ async def lifespan(app: FastAPI):
 app = FastAPI(
     title="Smart Home Controller",
     version="0.2.1",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # orjson 直接输出 bytes，序列化聚合数据时比标准库 json 更快
+    default_response_class=ORJSONResponse
 )
 
 # 使用绝对路径定位 static 目录，适配 Vercel 环境
@@ -118,14 +129,30 @@ if os.path.exists(STATIC_DIR):
 else:
     print(f"Warning: Static directory not found at {STATIC_DIR}")
 
+class HTMLPages(StaticFiles):
+    """页面路由：/ -> index.html, /litterbox -> litterbox.html, /feeder/plans -> feeder_plans.html
+    交给 StaticFiles 处理，自带 ETag/Last-Modified 协商缓存 (304)
+    """
+    def get_path(self, scope) -> str:
+        path = super().get_path(scope)
+        if path != "." and not os.path.splitext(path)[1]:
+            path = path.replace(os.sep, "_") + ".html"
+        return path
+
+# 注意：自定义中间件请写成纯 ASGI 类 (__call__(scope, receive, send))，
+# 不要继承 BaseHTTPMiddleware，后者会额外缓冲请求/响应并影响流式输出
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
-    allow_credentials=True,
+    # 通配 origin 下浏览器不会发送凭据，前端也不依赖 Cookie
+    allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# 压缩较大的 JSON 响应（设备列表、仪表板、体重历史），小响应不压缩以免浪费 CPU
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # --- 3. 依赖注入 ---
 def get_petkit():
     """快速获取已登录的 PetKit 实例"""
@@ -133,30 +160,40 @@ def get_petkit():
         raise HTTPException(status_code=503, detail="PetKit service not initialized or credentials missing")
     return state.petkit
 
-# --- 4. 数据模型 (Schema) ---
-# (使用 models.py 中的定义)
+async def fetch_devices_stats(service: PetKitService, device_ids: List[str], timeout: Optional[float] = None) -> Dict[str, Any]:
+    """并发获取多个设备的今日统计：先批量查缓存，未命中的设备并发请求上游（N×RTT -> 1×RTT）
 
-# --- 5. 路由实现 ---
+    Args:
+        timeout: 单个设备的超时时间（秒），超时或出错的设备返回 None，不拖慢其他设备
+    """
+    cached = await async_cache_manager.mget([f'petkit_stats_{i}' for i in device_ids])
+    stats_map = {i: cached[f'petkit_stats_{i}'] for i in device_ids}
 
-@app.get("/")
-async def root():
-    return FileResponse(os.path.join(STATIC_DIR, 'index.html'))
+    async def fetch_one(device_id: str):
+        try:
+            # 缓存统计信息3分钟
+            stats = await asyncio.wait_for(
+                async_cache_manager.get_or_load(
+                    f'petkit_stats_{device_id}', lambda: service.get_daily_stats(device_id), ttl=180
+                ),
+                timeout=timeout,
+            )
+        except Exception as e:
+            print(f"获取设备 {device_id} 统计失败: {e!r}")
+            return device_id, None
+        return device_id, stats
 
-@app.get("/litterbox")
-async def litterbox_page():
-    return FileResponse(os.path.join(STATIC_DIR, 'litterbox.html'))
+    missing = [i for i in device_ids if not stats_map[i]]
+    if missing:
+        results = await asyncio.gather(*(fetch_one(i) for i in missing))
+        stats_map.update(results)
 
-@app.get("/feeder")
-async def feeder_page():
-    return FileResponse(os.path.join(STATIC_DIR, 'feeder.html'))
+    return stats_map
 
-@app.get("/feeder/plans")
-async def feeder_plans_page():
-    return FileResponse(os.path.join(STATIC_DIR, 'feeder_plans.html'))
+# --- 4. 数据模型 (Schema) ---
+# (使用 models.py 中的定义)
 
-@app.get("/scale")
-async def scale_page():
-    return FileResponse(os.path.join(STATIC_DIR, 'scale.html'))
+# --- 5. 路由实现 ---
 
 @app.get("/api/cache/status")
 async def cache_status():
@@ -178,62 +215,71 @@ async def force_refresh_cache():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"刷新失败: {str(e)}")
 
+def cached_json_response(request: Request, data) -> Response:
+    """为只读缓存数据附加 ETag，内容未变化时直接返回 304
+
+    设备状态在控制指令后会立即变化，不允许浏览器或中间代理直接复用旧响应，每次都用 ETag 重新验证
+    """
+    # state_summary 中可能带有 pypetkitapi 的 pydantic 模型（如 WorkState），交给 jsonable_encoder 转换
+    body = orjson.dumps(data, default=jsonable_encoder, option=orjson.OPT_NON_STR_KEYS)
+    etag = f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/api/dashboard/data")
-async def get_dashboard_data():
+async def get_dashboard_data(request: Request):
     """获取首页聚合数据（优先从缓存获取）"""
     try:
-        # 尝试从缓存获取数据
-        cached_data = await async_cache_manager.get('dashboard_combined_data')
-        if cached_data:
-            return cached_data
-        
-        # 缓存未命中，实时获取数据
-        dashboard_data = {}
-        
-        # 获取PetKit设备数据
-        petkit_devices = await async_cache_manager.get('petkit_devices')
+        # 尝试从缓存获取数据，并发未命中时只构建一次
+        data = await async_cache_manager.get_or_load('dashboard_combined_data', build_dashboard_data, ttl=60)
+        return cached_json_response(request, data)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取仪表板数据失败: {str(e)}")
+
+async def build_dashboard_data():
+    """构建首页聚合数据：一次批量读取子缓存，只对未命中的部分并发请求上游"""
+    cached = await async_cache_manager.mget(['petkit_devices', 'cloudpets_servings', 'cloudpets_plans'])
+
+    async def load_petkit():
+        petkit_devices = cached['petkit_devices']
         if not petkit_devices and state.petkit:
-            petkit_devices = await state.petkit.get_devices()
-            await async_cache_manager.set('petkit_devices', petkit_devices, ttl=300)
-        
-        dashboard_data['petkit_devices'] = petkit_devices or []
-        
+            petkit_devices = await async_cache_manager.get_or_load('petkit_devices', state.petkit.get_devices, ttl=300)
+
         # 获取猫厕所统计数据
         litterbox_stats = {}
-        if petkit_devices:
-            for device in petkit_devices:
-                if hasattr(device, 'id'):
-                    cache_key = f'petkit_stats_{device.id}'
-                    stats = await async_cache_manager.get(cache_key)
-                    if not stats and state.petkit:
-                        stats = await state.petkit.get_daily_stats(device.id)
-                        await async_cache_manager.set(cache_key, stats, ttl=180)
-                    litterbox_stats[device.id] = stats or {}
-        
-        dashboard_data['litterbox_stats'] = litterbox_stats
-        
-        # 获取CloudPets数据
-        cloudpets_servings = await async_cache_manager.get('cloudpets_servings')
-        if not cloudpets_servings:
-            cloudpets_servings = await cloudpets_service.get_servings_today()
-            await async_cache_manager.set('cloudpets_servings', cloudpets_servings, ttl=120)
-        
-        dashboard_data['cloudpets_servings'] = cloudpets_servings
-        
-        cloudpets_plans = await async_cache_manager.get('cloudpets_plans')
-        if not cloudpets_plans:
-            cloudpets_plans = await cloudpets_service.get_feeding_plans()
-            await async_cache_manager.set('cloudpets_plans', cloudpets_plans, ttl=300)
-        
-        dashboard_data['cloudpets_plans'] = cloudpets_plans or []
-        
-        # 缓存聚合数据
-        await async_cache_manager.set('dashboard_combined_data', dashboard_data, ttl=60)
-        
-        return dashboard_data
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"获取仪表板数据失败: {str(e)}")
+        if petkit_devices and state.petkit:
+            device_ids = [d.id for d in petkit_devices if d.id]
+            stats_map = await fetch_devices_stats(state.petkit, device_ids, timeout=2.0)
+            litterbox_stats = {i: stats_map.get(i) or {} for i in device_ids}
+        return petkit_devices or [], litterbox_stats
+
+    async def load_servings():
+        servings = cached['cloudpets_servings']
+        if not servings:
+            servings = await async_cache_manager.get_or_load('cloudpets_servings', cloudpets_service.get_servings_today, ttl=120)
+        return servings
+
+    async def load_plans():
+        plans = cached['cloudpets_plans']
+        if not plans:
+            plans = await async_cache_manager.get_or_load('cloudpets_plans', cloudpets_service.get_feeding_plans, ttl=300)
+        return plans or []
+
+    (petkit_devices, litterbox_stats), cloudpets_servings, cloudpets_plans = await asyncio.gather(
+        load_petkit(), load_servings(), load_plans()
+    )
+
+    return {
+        'petkit_devices': petkit_devices,
+        'litterbox_stats': litterbox_stats,
+        'cloudpets_servings': cloudpets_servings,
+        'cloudpets_plans': cloudpets_plans,
+    }
 
 @app.get("/api/petkit/debug")
 async def petkit_debug(service: PetKitService = Depends(get_petkit)):
@@ -242,20 +288,21 @@ async def petkit_debug(service: PetKitService = Depends(get_petkit)):
     return await service.get_client_methods()
 
 @app.get("/api/petkit/devices")
-async def petkit_devices(service: PetKitService = Depends(get_petkit)):
+async def petkit_devices(request: Request, fields: Optional[str] = None, service: PetKitService = Depends(get_petkit)):
+    """fields: 逗号分隔的 state_summary 字段名，只返回这些字段（如 ?fields=sand_percent,used_times）"""
     if not service or not service.username or not service.password:
         raise HTTPException(status_code=503, detail="PetKit service not initialized or credentials missing")
     try:
-        # 优先从缓存获取
-        cached_devices = await async_cache_manager.get('petkit_devices')
-        if cached_devices:
-            return cached_devices
-        
-        # 缓存未命中，从服务获取
-        devices = await service.get_devices()
-        # 缓存5分钟
-        await async_cache_manager.set('petkit_devices', devices, ttl=300)
-        return devices
+        # 优先从缓存获取，未命中时从服务获取并缓存5分钟
+        devices = await async_cache_manager.get_or_load('petkit_devices', service.get_devices, ttl=300)
+        if fields:
+            # 在缓存的完整结果上裁剪，不同字段组合共用同一份缓存
+            wanted = frozenset(f.strip() for f in fields.split(','))
+            devices = [
+                replace(d, state_summary={k: v for k, v in d.state_summary.items() if k in wanted})
+                for d in devices
+            ]
+        return cached_json_response(request, devices)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch devices: {str(e)}")
 
@@ -264,21 +311,26 @@ async def petkit_clean(device_id: Optional[str] = None, service: PetKitService =
     if not service or not service.username or not service.password:
         raise HTTPException(status_code=503, detail="PetKit service not initialized or credentials missing")
     try:
-        return await service.clean_litterbox(device_id)
+        result = await service.clean_litterbox(device_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Action failed: {str(e)}")
+    # 设备状态已变化，丢弃缓存的设备列表
+    await async_cache_manager.delete('petkit_devices')
+    return result
 
 @app.post("/api/petkit/deodorize")
 async def petkit_deodorize(device_id: Optional[str] = None, service: PetKitService = Depends(get_petkit)):
     if not service or not service.username or not service.password:
         raise HTTPException(status_code=503, detail="PetKit service not initialized or credentials missing")
     try:
-        return await service.deodorize_litterbox(device_id)
+        result = await service.deodorize_litterbox(device_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    await async_cache_manager.delete('petkit_devices')
+    return result
 
 @app.get("/api/petkit/stats")
-async def petkit_daily_stats(device_id: Optional[str] = None, service: PetKitService = Depends(get_petkit)):
+async def petkit_daily_stats(request: Request, device_id: Optional[str] = None, service: PetKitService = Depends(get_petkit)):
     """获取今日统计数据（修复后的准确数据）"""
     if not service or not service.username or not service.password:
         raise HTTPException(status_code=503, detail="PetKit service not initialized or credentials missing")
@@ -286,16 +338,9 @@ async def petkit_daily_stats(device_id: Optional[str] = None, service: PetKitSer
         # 构建缓存键
         cache_key = f'petkit_stats_{device_id or "default"}'
         
-        # 优先从缓存获取
-        cached_stats = await async_cache_manager.get(cache_key)
-        if cached_stats:
-            return cached_stats
-        
-        # 缓存未命中，从服务获取
-        stats = await service.get_daily_stats(device_id)
-        # 缓存3分钟
-        await async_cache_manager.set(cache_key, stats, ttl=180)
-        return stats
+        # 优先从缓存获取，未命中时从服务获取并缓存3分钟
+        stats = await async_cache_manager.get_or_load(cache_key, lambda: service.get_daily_stats(device_id), ttl=180)
+        return cached_json_response(request, stats)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取统计数据失败: {str(e)}")
 
@@ -316,41 +361,16 @@ async def petkit_devices_with_stats(service: PetKitService = Depends(get_petkit)
         raise HTTPException(status_code=503, detail="PetKit service not initialized or credentials missing")
     
     try:
-        # 优先从缓存获取完整数据
-        cached_data = await async_cache_manager.get('petkit_devices_with_stats')
-        if cached_data:
-            return cached_data
-        
-        # 缓存未命中，获取设备列表
-        devices = await service.get_devices()
-        
-        # 为每个设备获取统计信息
-        result = []
-        for device in devices:
-            device_id = getattr(device, 'id', '') if hasattr(device, 'id') else ''
-            if device_id:
-                # 优先从缓存获取统计信息
-                stats_cache_key = f'petkit_stats_{device_id}'
-                stats = await async_cache_manager.get(stats_cache_key)
-                if not stats:
-                    stats = await service.get_daily_stats(device_id)
-                    # 缓存统计信息3分钟
-                    await async_cache_manager.set(stats_cache_key, stats, ttl=180)
-                
-                device_dict = device if isinstance(device, dict) else {
-                    "id": device_id,
-                    "name": getattr(device, 'name', 'Unknown'),
-                    "type": getattr(device, 'type', 'Unknown'),
-                    "data": getattr(device, 'data', {})
-                }
-                device_dict['stats'] = stats
-                result.append(device_dict)
-            else:
-                result.append(device)
-        
-        # 缓存完整结果2分钟
-        await async_cache_manager.set('petkit_devices_with_stats', result, ttl=120)
-        return result
+        async def build():
+            # 获取设备列表
+            devices = await service.get_devices()
+
+            # 并发获取所有设备的统计信息
+            stats_map = await fetch_devices_stats(service, [d.id for d in devices if d.id])
+            return [replace(d, stats=stats_map.get(d.id)) for d in devices]
+
+        # 优先从缓存获取完整数据，未命中时构建并缓存2分钟
+        return await async_cache_manager.get_or_load('petkit_devices_with_stats', build, ttl=120)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取设备和统计数据失败: {str(e)}")
 
@@ -391,28 +411,48 @@ async def petwant_feed():
     return {"status": "error", "message": "Use /api/cloudpets/feed instead."}
 
 @app.get("/api/petwant/plans", response_model=List[FeedingPlan])
-def get_plans(session: Session = Depends(get_session)):
+async def get_plans(session: AsyncSession = Depends(get_session)):
     # Local plans for compatibility
-    plans = session.exec(select(FeedingPlan)).all()
-    return plans
+    result = await session.exec(select(FeedingPlan))
+    return result.all()
 
 # --- Scale & User 路由 ---
 @app.get("/api/users", response_model=List[User])
-def get_users(session: Session = Depends(get_session)):
-    return session.exec(select(User)).all()
+async def get_users(session: AsyncSession = Depends(get_session)):
+    result = await session.exec(select(User))
+    return result.all()
 
 @app.post("/api/users", response_model=User)
-def create_user(user: User, session: Session = Depends(get_session)):
+async def create_user(user: User, session: AsyncSession = Depends(get_session)):
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    await session.commit()
+    await session.refresh(user)
     return user
 
 @app.get("/api/scale/history/{user_id}")
-def get_weight_history(user_id: int, session: Session = Depends(get_session)):
-    statement = select(WeightRecord).where(WeightRecord.user_id == user_id).order_by(WeightRecord.timestamp.desc()).limit(30)
-    results = session.exec(statement).all()
-    return results
+async def get_weight_history(user_id: int, limit: int = Query(30, ge=1, le=5000)):
+    """按时间倒序流式返回体重记录，逐行编码输出，内存占用与 limit 无关"""
+    statement = (
+        select(WeightRecord)
+        .where(WeightRecord.user_id == user_id)
+        .order_by(WeightRecord.timestamp.desc())
+        .limit(limit)
+        .execution_options(yield_per=200)
+    )
+
+    async def generate():
+        # 会话在生成器内部创建，保证整个流式输出期间连接有效
+        async with AsyncSession(get_engine()) as session:
+            yield b"["
+            first = True
+            async for record in await session.stream_scalars(statement):
+                if not first:
+                    yield b","
+                yield orjson.dumps(record.model_dump())
+                first = False
+            yield b"]"
+
+    return StreamingResponse(generate(), media_type="application/json")
 
 def calculate_body_metrics(weight: float, impedance: int, user: User):
     """
@@ -466,11 +506,48 @@ def calculate_body_metrics(weight: float, impedance: int, user: User):
         "bmr": round(bmr, 0)
     }
 
+def calculate_body_metrics_batch(weights, impedances, users: List[User]) -> List[dict]:
+    """
+    calculate_body_metrics 的向量化版本，用于批量导入历史体重数据
+    每个公式对整列数据做一次 NumPy 广播运算，舍入使用与逐条计算相同的 round()，结果与逐条计算一致
+    """
+    # 延迟导入：只有批量导入时才需要 NumPy，避免拖慢 Serverless 冷启动
+    import numpy as np
+
+    weights = np.asarray(weights, dtype=float)
+    impedances = np.asarray(impedances, dtype=float)
+    heights = np.array([u.height for u in users], dtype=float) / 100.0
+    ages = np.array([u.age for u in users], dtype=float)
+    is_male = np.array([u.gender == "male" for u in users], dtype=bool)
+
+    bmi = weights / (heights * heights)
+    body_fat = 0.8 * bmi + 0.1 * ages + np.where(is_male, -5.4, 4.1)
+    body_fat += np.where(impedances > 0, (impedances - 500) / 100.0, 0.0)
+    body_fat = np.clip(body_fat, 5.0, 50.0)
+
+    # 只用 NumPy 计算未舍入的数值；np.round 按二进制浮点值做银行家舍入，
+    # 与标量版本使用的内置 round() 在 .x5 附近会差 0.1，因此舍入统一交给 round()
+    columns = {
+        "bmi": (bmi, 1),
+        "body_fat": (body_fat, 1),
+        "muscle": (weights * (1 - body_fat / 100.0) * 0.75, 1),
+        "water": ((100 - body_fat) * 0.7, 1),
+        "visceral_fat": (np.clip(bmi - 13.0, 1.0, 20.0), 1),
+        "bone_mass": (weights * 0.04, 1),
+        "bmr": (weights * np.where(is_male, 24.0, 22.0), 0),
+    }
+    rounded = {
+        name: [round(x, ndigits) for x in values.tolist()]
+        for name, (values, ndigits) in columns.items()
+    }
+    names = list(rounded)
+    return [dict(zip(names, row)) for row in zip(*rounded.values())]
+
 @app.post("/api/scale/record")
-def record_weight(record: WeightRecord, session: Session = Depends(get_session)):
+async def record_weight(record: WeightRecord, session: AsyncSession = Depends(get_session)):
     # 如果有阻抗但没有详细指标，则在后端计算
     if record.impedance and not record.body_fat:
-        user = session.get(User, record.user_id)
+        user = await session.get(User, record.user_id)
         if user:
             metrics = calculate_body_metrics(record.weight, record.impedance, user)
             record.bmi = metrics["bmi"]
@@ -482,30 +559,75 @@ def record_weight(record: WeightRecord, session: Session = Depends(get_session))
             record.bmr = metrics["bmr"]
 
     session.add(record)
-    session.commit()
-    session.refresh(record)
+    await session.commit()
+    await session.refresh(record)
     return {"status": "success", "id": record.id}
 
+@app.post("/api/scale/records")
+async def record_weights(records: List[WeightRecord], session: AsyncSession = Depends(get_session)):
+    """批量导入历史体重记录，缺少详细指标的记录统一向量化计算"""
+    pending = [r for r in records if r.impedance and not r.body_fat]
+    if pending:
+        user_ids = {r.user_id for r in pending}
+        result = await session.exec(select(User).where(User.id.in_(user_ids)))
+        users = {u.id: u for u in result.all()}
+        pending = [r for r in pending if r.user_id in users]
+
+    if pending:
+        metrics_list = calculate_body_metrics_batch(
+            [r.weight for r in pending],
+            [r.impedance for r in pending],
+            [users[r.user_id] for r in pending],
+        )
+        for record, metrics in zip(pending, metrics_list):
+            for field, value in metrics.items():
+                setattr(record, field, value)
+
+    await bulk_insert(session, WeightRecord, [r.model_dump(exclude={"id"}) for r in records])
+    return {"status": "success", "count": len(records)}
+
 # --- Known Devices 路由 ---
 @app.get("/api/devices/known", response_model=List[KnownDevice])
-def get_known_devices(session: Session = Depends(get_session)):
-    return session.exec(select(KnownDevice)).all()
+async def get_known_devices(session: AsyncSession = Depends(get_session)):
+    result = await session.exec(select(KnownDevice))
+    return result.all()
 
 @app.post("/api/devices/bind")
-def bind_device(device: KnownDevice, session: Session = Depends(get_session)):
-    existing = session.exec(select(KnownDevice).where(KnownDevice.device_id == device.device_id)).first()
-    if existing:
-        existing.last_seen = int(time.time() * 1000)
-        session.add(existing)
-    else:
-        session.add(device)
-    session.commit()
+async def bind_device(device: KnownDevice, session: AsyncSession = Depends(get_session)):
+    # 单条 UPSERT：已存在则只刷新 last_seen，避免先查后写的两次往返和并发重复绑定
+    # last_seen 统一使用数据库时钟，避免多个实例之间的时间漂移
+    stmt = dialect_insert(KnownDevice).values(**device.model_dump(exclude={"id", "last_seen"}), last_seen=db_now_ms())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[KnownDevice.device_id],
+        set_={"last_seen": db_now_ms()},
+    )
+    await session.exec(stmt)
+    await session.commit()
     return {"status": "success"}
 
 @app.delete("/api/devices/unbind/{device_id}")
-def unbind_device(device_id: str, session: Session = Depends(get_session)):
-    device = session.exec(select(KnownDevice).where(KnownDevice.device_id == device_id)).first()
+async def unbind_device(device_id: str, session: AsyncSession = Depends(get_session)):
+    result = await session.exec(select(KnownDevice).where(KnownDevice.device_id == device_id))
+    device = result.first()
     if device:
-        session.delete(device)
-        session.commit()
+        await session.delete(device)
+        await session.commit()
     return {"status": "success"}
+
+
+# 页面挂载在根路径，必须放在所有 /api 路由之后注册
+if os.path.exists(STATIC_DIR):
+    app.mount("/", HTMLPages(directory=STATIC_DIR, html=True), name="pages")
+
+
+if __name__ == "__main__":
+    # uvloop 不支持 Windows，其余平台使用 uvloop + httptools 提升 I/O 吞吐
+    import sys
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 2)),
+    )
@@ -1,6 +1,12 @@
-from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event, func, cast, insert, BigInteger
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.pool import StaticPool
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 import tempfile
 
@@ -17,43 +23,141 @@ else:
     load_dotenv()
     print("Loaded .env from current directory")
 
-# Vercel Postgres 使用 "POSTGRES_URL"
-# Serverless 环境下如果未配置 Postgres，回退到内存数据库 (sqlite:///:memory:) 避免文件权限错误
-# 本地开发默认使用 SQLite 文件 (sqlite:///./auto_home.db)
+@lru_cache(maxsize=1)
+def get_settings() -> dict:
+    """账号配置，只在首次调用时读取环境变量"""
+    return {
+        "account": os.getenv("ACCOUNT"),
+        "password": os.getenv("PASSWORD"),
+    }
 
-# 增强的 Serverless 环境检测
-is_serverless = os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME") or os.getenv("R_LIBS_USER")
+@lru_cache(maxsize=1)
+def get_engine():
+    """创建全局唯一的数据库引擎，环境变量解析和 URL 改写只执行一次"""
+    # Vercel Postgres 使用 "POSTGRES_URL"
+    # Serverless 环境下如果未配置 Postgres，回退到内存数据库 (sqlite:///:memory:) 避免文件权限错误
+    # 本地开发默认使用 SQLite 文件 (sqlite:///./auto_home.db)
 
-if is_serverless:
-    print("Detected Serverless Environment.")
-    database_url = os.getenv("POSTGRES_URL")
-    if not database_url:
-        print("No POSTGRES_URL found. Falling back to in-memory SQLite database.")
-        database_url = "sqlite:///:memory:"
-else:
-    # 本地开发使用文件数据库以支持持久化测试
-    database_url = os.getenv("DATABASE_URL") or "sqlite:///./auto_home.db"
+    # 增强的 Serverless 环境检测
+    is_serverless = os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME") or os.getenv("R_LIBS_USER")
+
+    if is_serverless:
+        print("Detected Serverless Environment.")
+        database_url = os.getenv("POSTGRES_URL")
+        if not database_url:
+            print("No POSTGRES_URL found. Falling back to in-memory SQLite database.")
+            database_url = "sqlite:///:memory:"
+    else:
+        # 本地开发使用文件数据库以支持持久化测试
+        database_url = os.getenv("DATABASE_URL") or "sqlite:///./auto_home.db"
+
+    print(f"Database URL: {database_url.split('://')[0]}://***") # Mask password if any
+
+    # SQLAlchemy 需要 postgresql:// 协议头，Vercel 默认给的是 postgres://
+    if database_url and database_url.startswith("postgres://"):
+        database_url = database_url.replace("postgres://", "postgresql://", 1)
+
+    # 使用异步驱动: Postgres -> asyncpg, SQLite -> aiosqlite
+    connect_args = {}
+    if database_url.startswith("postgresql://"):
+        database_url = database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+        # asyncpg 不识别 libpq 的 sslmode 参数，转换为 connect_args 中的 ssl
+        parts = urlsplit(database_url)
+        query = dict(parse_qsl(parts.query))
+        sslmode = query.pop("sslmode", None)
+        if sslmode:
+            database_url = urlunsplit(parts._replace(query=urlencode(query)))
+            if sslmode != "disable":
+                connect_args["ssl"] = sslmode
+    elif database_url.startswith("sqlite://"):
+        database_url = database_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+    # SQLite 需要特殊参数 check_same_thread=False；timeout 让写锁冲突时等待而不是立即报 database is locked
+    if "sqlite" in database_url:
+        connect_args["check_same_thread"] = False
+        connect_args["timeout"] = 30
 
-print(f"Database URL: {database_url.split('://')[0]}://***") # Mask password if any
+    # 如果是 SQLite 内存数据库，必须使用 StaticPool 保持连接不关闭，否则数据会丢失
+    poolclass = None
+    if "sqlite" in database_url and ":memory:" in database_url:
+        poolclass = StaticPool
+        print("Using StaticPool for in-memory SQLite database.")
 
-# SQLAlchemy 需要 postgresql:// 协议头，Vercel 默认给的是 postgres://
-if database_url and database_url.startswith("postgres://"):
-    database_url = database_url.replace("postgres://", "postgresql://", 1)
+    # Postgres 默认连接池 (5 + 10) 在并发请求下容易耗尽，这里放大并开启失效检测；
+    # pool_timeout 让请求在拿不到连接时快速失败，而不是长时间挂起 worker
+    engine_kwargs = {}
+    if "postgresql" in database_url:
+        engine_kwargs = {
+            "pool_size": int(os.getenv("DB_POOL_SIZE", 20)),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 40)),
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+            "pool_timeout": 10,
+        }
+    elif poolclass is None:
+        # SQLite 文件库：后台刷新任务和请求会并发读写，同样使用连接池
+        engine_kwargs = {
+            "pool_size": 10,
+            "max_overflow": 20,
+            "pool_timeout": 30,
+            "pool_pre_ping": True,
+        }
 
-# SQLite 需要特殊参数 check_same_thread=False
-connect_args = {"check_same_thread": False} if "sqlite" in database_url else {}
+    # insertmanyvalues 将多行 INSERT 合并为每批 1000 行的单条语句
+    engine = create_async_engine(
+        database_url,
+        echo=False,
+        connect_args=connect_args,
+        poolclass=poolclass,
+        insertmanyvalues_page_size=1000,
+        **engine_kwargs,
+    )
 
-# 如果是 SQLite 内存数据库，必须使用 StaticPool 保持连接不关闭，否则数据会丢失
-poolclass = None
-if "sqlite" in database_url and ":memory:" in database_url:
-    poolclass = StaticPool
-    print("Using StaticPool for in-memory SQLite database.")
+    # SQLite 默认的 DELETE 日志 + FULL 同步会让每次写入都串行并 fsync，改用 WAL 提升写入吞吐
+    if "sqlite" in database_url:
+        event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
 
-engine = create_engine(database_url, echo=False, connect_args=connect_args, poolclass=poolclass)
+    return engine
 
-def init_db():
-    SQLModel.metadata.create_all(engine)
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA cache_size=-64000",
+)
 
-def get_session():
-    with Session(engine) as session:
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+async def init_db():
+    async with get_engine().begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+async def get_session():
+    # expire_on_commit=False: 异步会话中提交后访问属性不能触发隐式懒加载
+    async with AsyncSession(get_engine(), expire_on_commit=False) as session:
         yield session
+
+async def bulk_insert(session: AsyncSession, model, rows: list):
+    """批量写入多行数据，一次往返代替逐条 session.add"""
+    if rows:
+        await session.exec(insert(model), params=rows)
+        await session.commit()
+
+def dialect_insert(model):
+    """返回当前数据库方言的 insert()，以便使用 on_conflict_do_update 实现 UPSERT"""
+    if get_engine().dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def db_now_ms():
+    """数据库端的当前毫秒时间戳表达式，多实例并发写入时以数据库时钟为准"""
+    if get_engine().dialect.name == "postgresql":
+        return cast(func.floor(func.extract("epoch", func.now()) * 1000), BigInteger)
+    # SQLite 没有 EXTRACT，用 julianday 换算 Unix 毫秒
+    return cast((func.julianday("now") - 2440587.5) * 86400000, BigInteger)
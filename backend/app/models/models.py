@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import Index
 from typing import Optional
 import time
 
@@ -10,6 +11,9 @@ class User(SQLModel, table=True):
     height: int = 175    # cm
 
 class WeightRecord(SQLModel, table=True):
+    # 覆盖 "按用户查询最近 N 条记录" (where user_id order by timestamp desc)
+    __table_args__ = (Index("ix_weight_user_ts", "user_id", "timestamp"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: Optional[int] = Field(default=None, foreign_key="user.id")
     weight: float
@@ -25,7 +29,7 @@ class WeightRecord(SQLModel, table=True):
 
 class KnownDevice(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    device_id: str = Field(unique=True) # BLE MAC or UUID
+    device_id: str = Field(unique=True, index=True) # BLE MAC or UUID
     name: str
     type: str # 'scale', 'camera', etc.
     last_seen: int = Field(default_factory=lambda: int(time.time() * 1000))
@@ -1,19 +1,31 @@
 import asyncio
+import hashlib
+import heapq
+import itertools
 import time
-from typing import Callable, Dict, Any, Optional
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from datetime import datetime
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
 
 class TaskScheduler:
-    """异步定时任务调度器"""
+    """异步定时任务调度器
+
+    所有任务共用一个按截止时间排序的最小堆和一个调度协程，截止时间按
+    interval 累加计算，回调耗时不会造成调度漂移。
+    """
     
     def __init__(self):
         self.tasks: Dict[str, Dict[str, Any]] = {}
         self.running = False
-        self._task_handles: Dict[str, asyncio.Task] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self._jobs: Dict[str, asyncio.Task] = {}
     
     async def add_task(self, name: str, func: Callable, interval: int, 
                       immediate: bool = False, *args, **kwargs):
@@ -35,39 +47,72 @@ class TaskScheduler:
         }
         
         if self.running:
-            await self._start_single_task(name)
+            self._schedule_first(name)
     
     async def remove_task(self, name: str):
-        """移除任务"""
-        if name in self._task_handles:
-            self._task_handles[name].cancel()
-            del self._task_handles[name]
+        """移除任务（堆中残留的条目在出堆时丢弃）"""
+        job = self._jobs.pop(name, None)
+        if job:
+            job.cancel()
         
         if name in self.tasks:
             del self.tasks[name]
     
-    async def _start_single_task(self, name: str):
-        """启动单个任务"""
-        if name not in self.tasks:
+    def _push(self, name: str, deadline: float):
+        # seq 标记任务当前有效的堆条目，被移除或重新添加的旧条目出堆时会被忽略
+        seq = next(self._seq)
+        self.tasks[name]['seq'] = seq
+        heapq.heappush(self._heap, (deadline, seq, name))
+        self._wakeup.set()
+    
+    def _schedule_first(self, name: str):
+        task_config = self.tasks[name]
+        now = asyncio.get_running_loop().time()
+        self._push(name, now if task_config['immediate'] else now + task_config['interval'])
+    
+    async def _run_job(self, name: str, task_config: Dict[str, Any]):
+        try:
+            await task_config['func'](*task_config['args'], **task_config['kwargs'])
+        except asyncio.CancelledError:
+            logger.info(f"Task {name} cancelled")
+        except Exception as e:
+            logger.error(f"Task {name} error: {e}")
+    
+    def _fire(self, name: str, task_config: Dict[str, Any]):
+        """不等待回调完成；上一次执行尚未结束时跳过本轮，避免同一任务重叠执行"""
+        job = self._jobs.get(name)
+        if job and not job.done():
+            logger.warning(f"Task {name} still running, skipping this tick")
             return
+        self._jobs[name] = asyncio.create_task(self._run_job(name, task_config))
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
             
-        task_config = self.tasks[name]
-        
-        async def task_loop():
-            try:
-                # 立即执行（如果需要）
-                if task_config['immediate']:
-                    await task_config['func'](*task_config['args'], **task_config['kwargs'])
-                
-                while True:
-                    await asyncio.sleep(task_config['interval'])
-                    await task_config['func'](*task_config['args'], **task_config['kwargs'])
-            except asyncio.CancelledError:
-                logger.info(f"Task {name} cancelled")
-            except Exception as e:
-                logger.error(f"Task {name} error: {e}")
-        
-        self._task_handles[name] = asyncio.create_task(task_loop())
+            # 丢弃已失效的堆顶条目
+            while self._heap:
+                _, seq, name = self._heap[0]
+                task_config = self.tasks.get(name)
+                if task_config is not None and task_config['seq'] == seq:
+                    break
+                heapq.heappop(self._heap)
+            
+            timeout = self._heap[0][0] - loop.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                # 睡到最近的截止时间，期间有任务增删会被提前唤醒
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            deadline, _, name = heapq.heappop(self._heap)
+            task_config = self.tasks[name]
+            self._fire(name, task_config)
+            # 事件循环被长时间阻塞时不补跑错过的周期
+            self._push(name, max(deadline + task_config['interval'], loop.time()))
     
     async def start(self):
         """启动所有任务"""
@@ -78,21 +123,27 @@ class TaskScheduler:
         logger.info("Starting task scheduler...")
         
         for name in self.tasks:
-            await self._start_single_task(name)
+            self._schedule_first(name)
+        self._runner = asyncio.create_task(self._run())
     
     async def stop(self):
         """停止所有任务"""
         self.running = False
         logger.info("Stopping task scheduler...")
         
-        for handle in self._task_handles.values():
+        handles = list(self._jobs.values())
+        if self._runner:
+            handles.append(self._runner)
+        for handle in handles:
             handle.cancel()
         
         # 等待所有任务完成
-        if self._task_handles:
-            await asyncio.gather(*self._task_handles.values(), return_exceptions=True)
+        if handles:
+            await asyncio.gather(*handles, return_exceptions=True)
         
-        self._task_handles.clear()
+        self._runner = None
+        self._jobs.clear()
+        self._heap.clear()
 
 
 # 全局调度器实例
@@ -106,6 +157,25 @@ class DataRefreshTask:
         self.petkit_service = petkit_service
         self.cloudpets_service = cloudpets_service
         self.cache_manager = cache_manager
+        self._last_hash: Dict[str, bytes] = {}
+    
+    async def _set_if_changed(self, key: str, value: Any, ttl: int):
+        """上游返回的数据未变化时只延长过期时间，不重新写入缓存"""
+        await self._set_many_if_changed({key: value}, ttl)
+    
+    async def _set_many_if_changed(self, items: Dict[str, Any], ttl: int):
+        """批量版本：有变化的项通过一次 mset 写入"""
+        changed = {}
+        for key, value in items.items():
+            digest = hashlib.blake2b(
+                orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS), digest_size=8
+            ).digest()
+            if self._last_hash.get(key) == digest and await self.cache_manager.touch(key, ttl):
+                continue
+            self._last_hash[key] = digest
+            changed[key] = value
+        if changed:
+            await self.cache_manager.mset(changed, ttl=ttl)
     
     async def refresh_petkit_data(self):
         """刷新PetKit设备数据"""
@@ -117,14 +187,17 @@ class DataRefreshTask:
             
             # 获取设备列表
             devices = await self.petkit_service.get_devices()
-            await self.cache_manager.set('petkit_devices', devices, ttl=300)  # 5分钟缓存
+            await self._set_if_changed('petkit_devices', devices, ttl=300)  # 5分钟缓存
             
-            # 为每个设备获取统计信息
-            for device in devices:
-                if hasattr(device, 'id'):
-                    stats = await self.petkit_service.get_daily_stats(device.id)
-                    cache_key = f'petkit_stats_{device.id}'
-                    await self.cache_manager.set(cache_key, stats, ttl=180)  # 3分钟缓存
+            # 并发获取每个设备的统计信息，单个设备失败不影响其他设备
+            ids = [device.id for device in devices]
+            results = await asyncio.gather(
+                *(self.petkit_service.get_daily_stats(i) for i in ids), return_exceptions=True
+            )
+            await self._set_many_if_changed({
+                f'petkit_stats_{i}': stats
+                for i, stats in zip(ids, results) if not isinstance(stats, Exception)
+            }, ttl=180)  # 3分钟缓存
                     
         except Exception as e:
             logger.error(f"Failed to refresh PetKit data: {e}")
@@ -139,11 +212,11 @@ class DataRefreshTask:
             
             # 获取今日投喂次数
             servings = await self.cloudpets_service.get_servings_today()
-            await self.cache_manager.set('cloudpets_servings', servings, ttl=120)  # 2分钟缓存
+            await self._set_if_changed('cloudpets_servings', servings, ttl=120)  # 2分钟缓存
             
             # 获取喂食计划
             plans = await self.cloudpets_service.get_feeding_plans()
-            await self.cache_manager.set('cloudpets_plans', plans, ttl=300)  # 5分钟缓存
+            await self._set_if_changed('cloudpets_plans', plans, ttl=300)  # 5分钟缓存
             
         except Exception as e:
             logger.error(f"Failed to refresh CloudPets data: {e}")
@@ -153,20 +226,12 @@ class DataRefreshTask:
         try:
             logger.info("Refreshing dashboard data...")
             
-            # 并行获取所有数据
-            tasks = []
-            
-            # PetKit数据
-            if self.petkit_service:
-                tasks.append(self.refresh_petkit_data())
-            
-            # CloudPets数据
-            if self.cloudpets_service:
-                tasks.append(self.refresh_cloudpets_data())
-            
-            # 等待所有任务完成
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
+            # 并行获取所有数据；各刷新函数自行捕获异常，单个失败不会取消其他任务
+            async with asyncio.TaskGroup() as tg:
+                if self.petkit_service:
+                    tg.create_task(self.refresh_petkit_data())
+                if self.cloudpets_service:
+                    tg.create_task(self.refresh_cloudpets_data())
                 
             # 标记数据已刷新
             await self.cache_manager.set('dashboard_last_refresh', time.time(), ttl=3600)
@@ -1,11 +1,13 @@
-import os
 import httpx
+import orjson
 import logging
 import asyncio
-from typing import Dict, Any, List, Optional
-from pydantic import BaseModel
-from sqlmodel import Session
-from ..models.db import engine
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
+from pydantic import BaseModel, PrivateAttr, model_validator
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.db import get_engine, dialect_insert, get_settings
 from ..models.models import SystemConfig
 import time
 
@@ -18,19 +20,17 @@ BASE_URL = "https://cn.cloudpets.net"
 CLOUDPETS_FAMILY_ID = "572807"
 DEVICE_ID = "336704"
 
-# 统一账号密码配置 (ACCOUNT/PASSWORD)
-# CloudPets 需要去除 "86-" 或 "+86" 前缀
-ACCOUNT = os.getenv("ACCOUNT")
-PASSWORD = os.getenv("PASSWORD")
+@lru_cache(maxsize=1)
+def get_cloudpets_credentials() -> Tuple[Optional[str], Optional[str]]:
+    """统一账号密码配置 (ACCOUNT/PASSWORD)，CloudPets 需要去除 "86-" 或 "+86" 前缀"""
+    settings = get_settings()
+    account = settings["account"]
+    if account and account.startswith(("86-", "+86")):
+        account = account[3:]
+    return account, settings["password"]
 
-CLOUDPETS_ACCOUNT = ACCOUNT
-if CLOUDPETS_ACCOUNT:
-    if CLOUDPETS_ACCOUNT.startswith("86-"):
-        CLOUDPETS_ACCOUNT = CLOUDPETS_ACCOUNT[3:]
-    elif CLOUDPETS_ACCOUNT.startswith("+86"):
-        CLOUDPETS_ACCOUNT = CLOUDPETS_ACCOUNT[3:]
-
-CLOUDPETS_PASSWORD = PASSWORD
+# 计划时间只有 24*60 种取值，预先生成 "HH:mm" 字符串按下标取用
+_HHMM = tuple(f"{h:02d}:{m:02d}" for h in range(24) for m in range(60))
 
 DEFAULT_HEADERS = {
     "authorization": "", # Will be filled from DB or Login
@@ -49,10 +49,41 @@ class FeedingPlan(BaseModel):
     weekdays: Optional[List[int]] = None # [1,2,3,4,5,6,7] (对应 daysOfWeek)
     remark: Optional[str] = ""
 
+    # 提交给 CloudPets 的 daysOfWeek ("1,2,3")，构造时计算一次，不出现在接口 schema 中
+    _weekdays_csv: str = PrivateAttr(default="1,2,3,4,5,6,7")
+
+    @model_validator(mode="after")
+    def _build_weekdays_csv(self):
+        if self.weekdays:
+            self._weekdays_csv = ",".join(map(str, self.weekdays))
+        return self
+
+    @property
+    def weekdays_csv(self) -> str:
+        return self._weekdays_csv
+
 class CloudPetsService:
     def __init__(self):
-        self.client = httpx.AsyncClient(base_url=BASE_URL, headers=DEFAULT_HEADERS, timeout=10.0)
+        # 预先构建两套请求头，每次请求直接复用，token 变化时统一更新
+        self._headers_form = dict(DEFAULT_HEADERS)
+        self._headers_bare = {k: v for k, v in DEFAULT_HEADERS.items() if k != "Content-Type"}
+        # 长连接复用 + HTTP/2 多路复用，并发刷新时不再为每个请求重新握手；
+        # 自定义 transport 时 http2/limits 必须配置在 transport 上才会生效
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60),
+            retries=2,
+        )
+        self.client = httpx.AsyncClient(
+            base_url=BASE_URL,
+            headers=DEFAULT_HEADERS,
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            transport=transport,
+        )
         # 不再同步加载，改为在 initialize 中异步加载
+        # 并发请求同时遇到 401 时只登录一次，其余请求等待同一个登录任务
+        self._login_lock = asyncio.Lock()
+        self._login_task: Optional[asyncio.Task] = None
 
     async def initialize(self):
         """Initialize service: load token from DB, or login if missing"""
@@ -69,48 +100,55 @@ class CloudPetsService:
     async def _load_token_from_db(self) -> bool:
         """Try to load the latest token from database"""
         try:
-            with Session(engine) as session:
-                config = session.get(SystemConfig, "cloudpets_token")
+            async with AsyncSession(get_engine()) as session:
+                config = await session.get(SystemConfig, "cloudpets_token")
                 if config:
-                    self.client.headers["authorization"] = config.value
+                    self._set_token(config.value)
                     logger.info("Loaded CloudPets token from database")
                     return True
-        except Exception as e:
+        except (OperationalError, ProgrammingError) as e:
+            # 表尚未创建等数据库错误按首次运行处理，其他异常照常抛出
             logger.warning(f"Could not load token from DB (might be first run): {e}")
         return False
 
     async def _save_token_to_db(self, token: str):
         """Save new token to database"""
         try:
-            with Session(engine) as session:
-                config = session.get(SystemConfig, "cloudpets_token")
-                if not config:
-                    config = SystemConfig(key="cloudpets_token", value=token)
-                    session.add(config)
-                else:
-                    config.value = token
-                    config.updated_at = int(time.time() * 1000)
-                    session.add(config)
-                session.commit()
+            # 单条 UPSERT，一次往返完成写入；登录已由 _relogin 合并，401 风暴时也只写一次
+            now = int(time.time() * 1000)
+            stmt = dialect_insert(SystemConfig).values(key="cloudpets_token", value=token, updated_at=now)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[SystemConfig.key],
+                set_={"value": token, "updated_at": now},
+            )
+            async with AsyncSession(get_engine()) as session:
+                await session.exec(stmt)
+                await session.commit()
                 logger.info("Saved new CloudPets token to database")
         except Exception as e:
             logger.error(f"Failed to save token to DB: {e}")
 
+    def _set_token(self, token: str):
+        self.client.headers["authorization"] = token
+        self._headers_form["authorization"] = token
+        self._headers_bare["authorization"] = token
+
     async def _login(self) -> bool:
         """
         Login to get new token
         Path: /app/terminal/user/login
         Method: POST
         """
-        if not CLOUDPETS_ACCOUNT or not CLOUDPETS_PASSWORD:
+        account, password = get_cloudpets_credentials()
+        if not account or not password:
             logger.error("Missing CloudPets credentials (CLOUDPETS_ACCOUNT/PASSWORD)")
             return False
 
         try:
-            logger.info(f"Attempting to login to CloudPets with account {CLOUDPETS_ACCOUNT}")
+            logger.info(f"Attempting to login to CloudPets with account {account}")
             payload = {
-                "account": CLOUDPETS_ACCOUNT,
-                "pwd": CLOUDPETS_PASSWORD,
+                "account": account,
+                "pwd": password,
                 "userType": "1"
             }
             # Login endpoint might need clean headers without old auth
@@ -123,7 +161,7 @@ class CloudPetsService:
 
             resp = await self.client.post("/app/terminal/user/login", data=payload, headers=login_headers)
             resp.raise_for_status()
-            data = resp.json()
+            data = orjson.loads(resp.content)
 
             # Assuming the token is in the response, e.g., data['authorization'] or data['token']
             # Based on standard OAuth/API patterns.
@@ -147,7 +185,7 @@ class CloudPetsService:
                 new_token = resp.headers["authorization"]
 
             if new_token:
-                self.client.headers["authorization"] = new_token
+                self._set_token(new_token)
                 await self._save_token_to_db(new_token)
                 return True
             else:
@@ -158,43 +196,48 @@ class CloudPetsService:
             logger.error(f"Login failed: {e}")
             return False
 
+    async def _relogin(self, stale_token: Optional[str]) -> bool:
+        """合并并发的重新登录，token 已被其他请求刷新时直接复用"""
+        async with self._login_lock:
+            if self.client.headers.get("authorization") != stale_token:
+                return True
+            if self._login_task is None or self._login_task.done():
+                self._login_task = asyncio.create_task(self._login())
+            task = self._login_task
+        return await task
+
     async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
         """
         Wrapper for HTTP requests with auto-login on 401 or specific business errors
         """
-        try:
-            resp = await self.client.request(method, url, **kwargs)
+        token = self.client.headers.get("authorization")
+        resp = await self.client.request(method, url, **kwargs)
+
+        # Check for HTTP 401
+        should_retry = resp.status_code == 401
+
+        # Also check for business logic 401 (sometimes APIs return 200 OK but with error code in body)
+        if not should_retry and resp.status_code == 200:
+            try:
+                data = orjson.loads(resp.content)
+                # Example: {"code": 401, "message": "Unauthorized"}
+                if isinstance(data, dict) and str(data.get("code")) == "401":
+                    should_retry = True
+                    logger.warning(f"Detected business logic 401: {data}")
+            except:
+                pass
 
-            # Check for HTTP 401
-            should_retry = resp.status_code == 401
+        if should_retry:
+            logger.warning("Received 401 from CloudPets, attempting to re-login...")
+            if await self._relogin(token):
+                # Retry the request with new token
+                # (预构建的请求头已在 _set_token 中同步更新)
+                logger.info("Retrying request with new token")
+                resp = await self.client.request(method, url, **kwargs)
+            else:
+                logger.error("Re-login failed, cannot retry request")
 
-            # Also check for business logic 401 (sometimes APIs return 200 OK but with error code in body)
-            if not should_retry and resp.status_code == 200:
-                try:
-                    data = resp.json()
-                    # Example: {"code": 401, "message": "Unauthorized"}
-                    if isinstance(data, dict) and str(data.get("code")) == "401":
-                        should_retry = True
-                        logger.warning(f"Detected business logic 401: {data}")
-                except:
-                    pass
-
-            if should_retry:
-                logger.warning("Received 401 from CloudPets, attempting to re-login...")
-                if await self._login():
-                    # Retry the request with new token
-                    # Update authorization header in kwargs if it was passed explicitly (rare)
-                    if "headers" in kwargs:
-                        kwargs["headers"]["authorization"] = self.client.headers["authorization"]
-
-                    logger.info("Retrying request with new token")
-                    resp = await self.client.request(method, url, **kwargs)
-                else:
-                    logger.error("Re-login failed, cannot retry request")
-
-            return resp
-        except Exception as e:
-            raise e
+        return resp
 
     async def close(self):
         await self.client.aclose()
@@ -212,10 +255,10 @@ class CloudPetsService:
             payload = {"deviceId": DEVICE_ID}
             resp = await self._request("POST", "/app/terminal/feeder/servingsToday", data=payload)
             resp.raise_for_status()
-            return resp.json()
-        except Exception as e:
-            logger.error(f"Failed to get servings today: {e}")
-            raise e
+            return orjson.loads(resp.content)
+        except Exception:
+            logger.exception("Failed to get servings today")
+            raise
 
     async def manual_feed(self, amount: int = 1) -> Dict[str, Any]:
         """
@@ -229,13 +272,13 @@ class CloudPetsService:
             resp = await self._request("POST", "/app/terminal/feeder/manualFeed", data=payload)
 
             if resp.status_code != 200:
-                logger.error(f"Manual feed failed with status {resp.status_code}: {resp.text}")
+                logger.error("Manual feed failed with status %s: %s", resp.status_code, resp.text)
 
             resp.raise_for_status()
-            return resp.json()
-        except Exception as e:
-            logger.error(f"Manual feed failed: {e}")
-            raise e
+            return orjson.loads(resp.content)
+        except Exception:
+            logger.exception("Manual feed failed")
+            raise
 
     async def get_feeding_plans(self) -> List[Dict[str, Any]]:
         """
@@ -245,10 +288,6 @@ class CloudPetsService:
         Params: deviceType=66&pageNum=1&pageSize=1000
         """
         try:
-            headers = self.client.headers.copy()
-            if "Content-Type" in headers:
-                del headers["Content-Type"]
-
             url = f"/app/terminal/feeder/planList/{DEVICE_ID}"
             params = {
                 "deviceType": "66",
@@ -256,10 +295,10 @@ class CloudPetsService:
                 "pageSize": "1000"
             }
 
-            resp = await self._request("GET", url, params=params, headers=headers)
+            resp = await self._request("GET", url, params=params, headers=self._headers_bare)
 
             resp.raise_for_status()
-            data = resp.json()
+            data = orjson.loads(resp.content)
 
             raw_list = []
             if "rows" in data:
@@ -275,9 +314,12 @@ class CloudPetsService:
             for item in raw_list:
                 try:
                     # Construct time HH:mm
-                    hour = item.get("hour", 0)
-                    minute = item.get("minute", 0)
-                    time_str = f"{int(hour):02d}:{int(minute):02d}"
+                    hour = int(item.get("hour", 0))
+                    minute = int(item.get("minute", 0))
+                    if 0 <= hour < 24 and 0 <= minute < 60:
+                        time_str = _HHMM[hour * 60 + minute]
+                    else:
+                        time_str = f"{hour:02d}:{minute:02d}"
 
                     plan = {
                         "id": str(item.get("id")),
@@ -307,18 +349,9 @@ class CloudPetsService:
             # Parse time HH:mm
             hour, minute = plan.time.split(':')
 
-            # Format weekdays: ensure "1,2,3" format
-            weekdays_val = plan.weekdays
-            if isinstance(weekdays_val, list):
-                weekdays_val = ",".join(map(str, weekdays_val))
-            elif isinstance(weekdays_val, str):
-                pass
-            else:
-                weekdays_val = "1,2,3,4,5,6,7"
-
             payload = {
                 "deviceId": DEVICE_ID,
-                "daysOfWeek": weekdays_val,
+                "daysOfWeek": plan.weekdays_csv,
                 "enable": str(plan.enabled).lower(), # true/false
                 "hour": hour,
                 "minute": minute,
@@ -326,16 +359,14 @@ class CloudPetsService:
                 "remark": plan.remark or ""
             }
 
-            headers = self.client.headers.copy()
-            headers["Content-Type"] = "application/x-www-form-urlencoded"
-
-            resp = await self._request("POST", "/app/terminal/feeder/feedPlan", data=payload, headers=headers)
-            logger.info(f"CloudPets ADD Plan Resp: {resp.status_code} {resp.text}")
+            resp = await self._request("POST", "/app/terminal/feeder/feedPlan", data=payload, headers=self._headers_form)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("CloudPets ADD Plan Resp: %s %s", resp.status_code, resp.text)
             resp.raise_for_status()
 
             # CloudPets returns {"code": 200, "result": "id_string"} or just success message
             # We need to return the plan object with ID to satisfy response_model=FeedingPlan
-            data = resp.json()
+            data = orjson.loads(resp.content)
             new_id = None
             if "result" in data:
                  new_id = str(data["result"])
@@ -352,9 +383,9 @@ class CloudPetsService:
                 "weekdays": plan.weekdays,
                 "remark": plan.remark
             }
-        except Exception as e:
-            logger.error(f"Failed to add feeding plan: {e}")
-            raise e
+        except Exception:
+            logger.exception("Failed to add feeding plan")
+            raise
 
     async def update_feeding_plan(self, plan_id: str, plan: FeedingPlan) -> Dict[str, Any]:
         """
@@ -365,22 +396,13 @@ class CloudPetsService:
         try:
             hour, minute = plan.time.split(':')
 
-            # Format weekdays
-            weekdays_val = plan.weekdays
-            if isinstance(weekdays_val, list):
-                weekdays_val = ",".join(map(str, weekdays_val))
-            elif isinstance(weekdays_val, str):
-                pass
-            else:
-                weekdays_val = "1,2,3,4,5,6,7"
-
             # CloudPets expects boolean string "true"/"false" for enable
             enable_str = "true" if plan.enabled else "false"
 
             payload = {
                 "id": plan_id, # Ensure ID is passed
                 "deviceId": DEVICE_ID,
-                "daysOfWeek": weekdays_val,
+                "daysOfWeek": plan.weekdays_csv,
                 "enable": enable_str,
                 "hour": hour,
                 "minute": minute,
@@ -388,14 +410,12 @@ class CloudPetsService:
                 "remark": plan.remark or ""
             }
 
-            headers = self.client.headers.copy()
-            headers["Content-Type"] = "application/x-www-form-urlencoded"
-
             # Log payload for debugging
-            logger.info(f"CloudPets UPDATE Payload: {payload}")
+            logger.info("CloudPets UPDATE Payload: %s", payload)
 
-            resp = await self._request("PUT", "/app/terminal/feeder/feedPlan", data=payload, headers=headers)
-            logger.info(f"CloudPets UPDATE Plan Resp: {resp.status_code} {resp.text}")
+            resp = await self._request("PUT", "/app/terminal/feeder/feedPlan", data=payload, headers=self._headers_form)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("CloudPets UPDATE Plan Resp: %s %s", resp.status_code, resp.text)
 
             resp.raise_for_status()
 
@@ -409,9 +429,9 @@ class CloudPetsService:
                 "weekdays": plan.weekdays,
                 "remark": plan.remark
             }
-        except Exception as e:
-            logger.error(f"Failed to update feeding plan: {e}")
-            raise e
+        except Exception:
+            logger.exception("Failed to update feeding plan")
+            raise
 
     async def delete_feeding_plan(self, plan_id: str) -> Dict[str, Any]:
         """
@@ -420,17 +440,13 @@ class CloudPetsService:
         Method: DELETE
         """
         try:
-            headers = self.client.headers.copy()
-            if "Content-Type" in headers:
-                del headers["Content-Type"]
-
             url = f"/app/terminal/feeder/plan/{plan_id}"
-            resp = await self._request("DELETE", url, headers=headers)
+            resp = await self._request("DELETE", url, headers=self._headers_bare)
 
             resp.raise_for_status()
             # DELETE response might be empty or json
             if resp.content:
-                result = resp.json()
+                result = orjson.loads(resp.content)
             else:
                 result = {"code": 200, "message": "Deleted"}
 
@@ -438,8 +454,8 @@ class CloudPetsService:
             await asyncio.sleep(1)
 
             return result
-        except Exception as e:
-            logger.error(f"Failed to delete feeding plan: {e}")
-            raise e
+        except Exception:
+            logger.exception("Failed to delete feeding plan")
+            raise
 
 cloudpets_service = CloudPetsService()
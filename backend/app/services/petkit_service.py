@@ -3,21 +3,146 @@
 import aiohttp
 from pypetkitapi.client import PetKitClient
 from pypetkitapi.command import LitterCommand, DeviceAction, LBCommand, DeviceCommand
-from pypetkitapi.exceptions import PetkitSessionExpiredError
+from pypetkitapi.exceptions import (
+    PetkitAuthenticationError,
+    PetkitInvalidHTTPResponseCodeError,
+    PetkitSessionExpiredError,
+)
+import pypetkitapi.command
 import logging
 import asyncio
-import json
+import os
+import orjson
+import re
 import time
-from sqlmodel import Session
-from ..models.db import engine
+from collections import deque
+from dataclasses import dataclass, field
+from operator import attrgetter
+from typing import Optional, Union
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.db import get_engine, dialect_insert
 from ..models.models import SystemConfig
+from ..utils.cache_manager import cache_manager
 
-logging.basicConfig(level=logging.INFO)
+# 生产环境可设置 LOG_LEVEL=WARNING 关闭常规日志
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+def _now_ms() -> int:
+    """进程内计时用的单调毫秒时钟，不受系统时间调整影响"""
+    return time.monotonic_ns() // 1_000_000
+
+def _wall_ms() -> int:
+    """需要写入数据库、跨进程重启比较的墙上时间毫秒数"""
+    return time.time_ns() // 1_000_000
+
+# pypetkitapi.command 中的公开常量，调试接口使用，导入时计算一次
+_CMD_CONSTANTS = {k: v for k, v in vars(pypetkitapi.command).items() if not k.startswith('_')}
+
+# 客户端限流：每 60 秒最多发起的 PetKit API 调用次数
+PETKIT_RPM_LIMIT = max(1, int(os.getenv("PETKIT_RPM_LIMIT", 30)))
+
+# get_devices 结果的缓存时间（秒）
+PETKIT_DEVICES_TTL = 10
+
+# 遇到这些状态码时退避后重试；502/503/504 已由 pypetkitapi 内部重试，这里只处理限流
+_BACKOFF_STATUSES = frozenset({429})
+
+# pypetkitapi 把非 2xx 响应包装为 PetkitInvalidHTTPResponseCodeError，消息中带状态码
+_HTTP_STATUS_RE = re.compile(r'status code (\d{3})')
+
+def _http_status(e: Exception) -> Optional[int]:
+    """取出 pypetkitapi 异常对应的 HTTP 状态码，优先读原始的 ClientResponseError"""
+    cause = e.__cause__
+    if isinstance(cause, aiohttp.ClientResponseError):
+        return cause.status
+    match = _HTTP_STATUS_RE.search(str(e))
+    return int(match.group(1)) if match else None
+
+# 支持的猫厕所型号
+_LITTERBOX_TYPES = frozenset({'T3', 'T4', 'T5'})
+
+# 设备类型未知时，名称中包含这些关键字的按 T4 (Pura MAX) 处理
+_LITTERBOX_NAME_HINTS = ('MAX', '猫厕所')
+
+# 设备类型标准化表：常见写法直接查表，表外的值再做 upper()
+_TYPE_NORMALIZE = {t: t.upper() for t in ('t3', 't4', 't5', 'T3', 'T4', 'T5')}
+_TYPE_NORMALIZE['T4 Pura MAX'] = 'T4'
+
+# 可以直接放进 JSON 响应的基本类型
+_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+# 设为 1 时在 state_summary 中附带完整的原始状态字符串，仅用于调试
+PETKIT_RAW_STATE = os.getenv("PETKIT_RAW_STATE") == "1"
+
+_RAW_STATE_FIELDS = (
+    'deodorant_left_days', 'sand_percent', 'sand_weight', 'used_times', 'frequent_restroom',
+    'liquid_lack', 'box_full', 'sand_lack', 'power', 'ota',
+)
+
+# 直接放进 state_summary 的设备实体属性（实体上没有时从 entity.data 中取）
+_INTERESTING = (
+    'liquid', 'weight', 'times', 'battery', 'connection',
+    'sand_percent', 'deodorant_left_days', 'used_times',
+)
+
+# 状态对象上直接复制的字段
+_STATE_ATTR_GETTERS = tuple(
+    (name, attrgetter(name))
+    for name in ('box_full', 'liquid_lack', 'box_state', 'work_state', 'error_state')
+)
+
+# (字段名, 取值函数...)：依次尝试 entity.state.<字段> 和 entity.<字段>，取第一个非 None 值
+_STATE_EXTRACTORS = tuple(
+    (name, (attrgetter(f'state.{name}'), attrgetter(name))) for name in _RAW_STATE_FIELDS
+)
+
+# 原始状态字符串中的关键字段，匹配 field=value 或 field=value,
+_RAW_STATE_KV_RE = re.compile(
+    r'\b(deodorant_left_days|sand_percent|sand_weight|used_times|frequent_restroom'
+    r'|liquid_lack|box_full|sand_lack|power|ota)=([\w\d\.-]+)'
+)
+_RAW_STATE_WIFI_RE = re.compile(r"wifi=Wifi\(bssid='(.*?)', rsq=(-?\d+)")
+
+def _coerce_state_value(value: str):
+    """尝试把状态字符串转换为适当的类型"""
+    lowered = value.lower()
+    if lowered in ('true', 'false'):
+        return lowered == 'true'
+    try:
+        if '.' in value:
+            return float(value)
+        if value.isdigit() or (value.startswith('-') and value[1:].isdigit()):
+            return int(value)
+    except ValueError:
+        pass
+    return value
+
+def _latest_stat_record(device_stats):
+    """statistic_info 的最后一条记录，没有记录或不支持下标访问时返回 None"""
+    stat_info = getattr(device_stats, 'statistic_info', None) or ()
+    try:
+        return stat_info[-1]
+    except (IndexError, TypeError):
+        return None
+
+def _latest_pet_weight_kg(device_stats) -> Optional[float]:
+    """最新一条记录中的猫咪体重（kg），没有有效体重时返回 None"""
+    weight = getattr(_latest_stat_record(device_stats), 'pet_weight', 0) or 0
+    return weight / 1000.0 if weight > 0 else None
+
+@dataclass(slots=True)
+class Device:
+    """get_devices 返回的设备结构，入口处统一转换，后续直接属性访问"""
+    id: str
+    name: str
+    type: str
+    data: Union[dict, str] = field(default_factory=dict)  # entity.data 不是字典时为其字符串形式
+    state_summary: dict = field(default_factory=dict)
+    stats: Optional[dict] = None
+
 class PetKitService:
     def __init__(self, username=None, password=None, region="CN", timezone="Asia/Shanghai"):
-        import os
         # 优先使用传入的参数，否则从环境变量获取
         self.username = username or os.getenv("ACCOUNT")
         self.password = password or os.getenv("PASSWORD")
@@ -26,35 +151,61 @@ class PetKitService:
         self.session = None
         self.client = None
         self.token_key = "petkit_session_data"  # 数据库存储键名
+        self._device_type_cache: dict = {}  # entity.id -> 设备类型
+        self._litterbox_ids: list = []  # 猫厕所设备 ID，每次刷新设备数据后重建
+        self._client_methods: Optional[list] = None  # get_client_methods 的缓存
+        # 设备数据短时缓存：列表和统计接口在几秒内重复调用时不再重复全量刷新
+        self._devices_data_ts = 0.0
+        self._devices_data_ttl = 5.0
+        self._refresh_lock = asyncio.Lock()
+        # 滑动窗口限流：最近的调用时间 (monotonic)，以及服务端要求暂停到的时间点
+        self._call_times: deque = deque(maxlen=PETKIT_RPM_LIMIT)
+        self._rate_lock = asyncio.Lock()
+        self._pause_until = 0.0
+        # 会话写库去抖：内容未变且距上次写入不足 60 秒时跳过，写入放到后台任务
+        self._session_cache: Optional[dict] = None
+        self._last_flush_ms = 0
+        self._flush_dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        # 冷启动时的并发请求只触发一次初始化/登录
+        self._init_lock = asyncio.Lock()
+        self._initialized = False
+        self._login_lock = asyncio.Lock()
+        self._login_gen = 0
+        self._login_ok = False
 
         if not self.username or not self.password:
             logger.warning("PetKit credentials not provided, service will not be available")
 
     async def initialize(self):
         """Initialize service: load session from DB, or login if missing"""
-        logger.info("Initializing PetKit Service...")
-        if not await self._load_session_from_db():
-            logger.info("No session found in DB, attempting initial login...")
-            if await self._login():
-                logger.info("Initial login successful")
+        async with self._init_lock:
+            if self._initialized:
+                return
+            logger.info("Initializing PetKit Service...")
+            if not await self._load_session_from_db():
+                logger.info("No session found in DB, attempting initial login...")
+                if await self._login():
+                    logger.info("Initial login successful")
+                    self._initialized = True
+                else:
+                    logger.error("Initial login failed")
             else:
-                logger.error("Initial login failed")
-        else:
-            logger.info("PetKit session loaded from DB")
+                logger.info("PetKit session loaded from DB")
+                self._initialized = True
 
     async def _load_session_from_db(self) -> bool:
         """Try to load the latest session data from database"""
         try:
-            with Session(engine) as session_db:
-                config = session_db.get(SystemConfig, self.token_key)
+            async with AsyncSession(get_engine()) as session_db:
+                config = await session_db.get(SystemConfig, self.token_key)
                 if config:
                     # 解析存储的会话数据
-                    session_data = json.loads(config.value)
+                    session_data = orjson.loads(config.value)
 
                     # 检查是否过期（30分钟有效期）
                     saved_time = session_data.get('timestamp', 0)
-                    current_time = int(time.time() * 1000)
-                    if current_time - saved_time > 30 * 60 * 1000:  # 30分钟
+                    if _wall_ms() - saved_time > 30 * 60 * 1000:  # 30分钟
                         logger.info("PetKit session expired (30min), need re-login")
                         return False
 
@@ -67,53 +218,79 @@ class PetKitService:
         return False
 
     async def _save_session_to_db(self):
-        """Save current session data to database"""
-        try:
-            if not self.client or not self.session:
-                return
-
-            # 获取会话相关信息
-            session_data = {
-                'timestamp': int(time.time() * 1000),
-                'region': self.region,
-                'timezone': self.timezone
-            }
-
-            # 尝试获取客户端的认证信息
+        """Save current session data to database (debounced, written in background)"""
+        if not self.client or not self.session:
+            return
+
+        # 获取会话相关信息
+        session_data = {
+            'region': self.region,
+            'timezone': self.timezone
+        }
+        now = _now_ms()
+        if session_data == self._session_cache and now - self._last_flush_ms < 60_000:
+            return
+
+        self._session_cache = session_data
+        self._last_flush_ms = now
+        self._flush_dirty = True
+        # 已有写入任务在运行时只标记 dirty，由该任务写入最新数据
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_session())
+
+    async def _flush_session(self):
+        while self._flush_dirty:
+            self._flush_dirty = False
+            now = _wall_ms()
+            session_data = {**self._session_cache, 'timestamp': now}
+            value = orjson.dumps(session_data).decode()
+            # 单条 UPSERT，一次往返完成写入
+            stmt = dialect_insert(SystemConfig).values(key=self.token_key, value=value, updated_at=now)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[SystemConfig.key],
+                set_={"value": stmt.excluded.value, "updated_at": stmt.excluded.updated_at},
+            )
             try:
-                if hasattr(self.client, 'req') and hasattr(self.client.req, 'session'):
-                    # 存储cookies或其他认证信息
-                    cookies = self.client.req.session.cookie_jar.filter_cookies()
-                    if cookies:
-                        session_data['cookies'] = str(cookies)
+                async with AsyncSession(get_engine()) as session_db:
+                    await session_db.exec(stmt)
+                    await session_db.commit()
+                    logger.info("Saved PetKit session to database")
             except Exception as e:
-                logger.debug(f"Could not extract session cookies: {e}")
-
-            with Session(engine) as session_db:
-                config = session_db.get(SystemConfig, self.token_key)
-                if not config:
-                    config = SystemConfig(key=self.token_key, value=json.dumps(session_data))
-                    session_db.add(config)
-                else:
-                    config.value = json.dumps(session_data)
-                    config.updated_at = int(time.time() * 1000)
-                    session_db.add(config)
-                session_db.commit()
-                logger.info("Saved PetKit session to database")
-        except Exception as e:
-            logger.error(f"Failed to save session to DB: {e}")
+                logger.error(f"Failed to save session to DB: {e}")
+
+    async def _ensure_session(self) -> aiohttp.ClientSession:
+        """返回可用的 HTTP 会话：已有且未关闭时直接复用，否则新建，避免覆盖未关闭的会话造成泄漏"""
+        if self.session and not self.session.closed:
+            return self.session
+        # 带长连接池，重新登录时复用，不必每次重新握手
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+        )
+        # 读取服务端的限流响应头，配额将尽时主动暂停
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(self._on_request_end)
+        # PetKit 通过请求头携带会话凭证，不依赖 cookie；DummyCookieJar 省去 cookie 解析和过期定时器
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trace_configs=[trace_config],
+            timeout=aiohttp.ClientTimeout(total=30, connect=10),
+        )
+        return self.session
 
     async def _restore_session(self, session_data: dict):
         """Restore session from stored data"""
         try:
-            # 创建新的会话
-            self.session = aiohttp.ClientSession()
             self.client = PetKitClient(
                 username=self.username,
                 password=self.password,
                 region=session_data.get('region', self.region),
                 timezone=session_data.get('timezone', self.timezone),
-                session=self.session,
+                session=await self._ensure_session(),
             )
 
             # 尝试恢复认证状态
@@ -129,23 +306,30 @@ class PetKitService:
         """
         Login to get new session
         """
+        gen = self._login_gen
+        async with self._login_lock:
+            # 等锁期间其他协程已经登录成功，直接复用
+            if self._login_gen != gen and self._login_ok:
+                return True
+            self._login_ok = await self._do_login()
+            self._login_gen += 1
+            return self._login_ok
+
+    async def _do_login(self) -> bool:
         try:
-            # 清理旧会话
-            if self.session:
-                await self.session.close()
-
-            # 创建新会话
-            self.session = aiohttp.ClientSession()
+            self._device_type_cache.clear()
             self.client = PetKitClient(
                 username=self.username,
                 password=self.password,
                 region=self.region,
                 timezone=self.timezone,
-                session=self.session,
+                session=await self._ensure_session(),
             )
 
             # 登录并获取设备列表
             await self.client.get_devices_data()
+            self._devices_data_ts = time.monotonic()
+            self._index_litterboxes()
             logger.info(f"PetKit 登录成功。共发现 {len(self.client.petkit_entities)} 个设备/实体。")
 
             # 保存会话到数据库
@@ -156,192 +340,244 @@ class PetKitService:
             logger.error(f"PetKit 登录失败: {e}")
             return False
 
+    def _devices_data_fresh(self) -> bool:
+        return time.monotonic() - self._devices_data_ts < self._devices_data_ttl
+
+    async def _refresh_devices(self, force=False):
+        """刷新设备数据，5 秒内已刷新过则跳过；并发调用合并为一次请求"""
+        if not force and self._devices_data_fresh():
+            return
+        async with self._refresh_lock:
+            # 等锁期间可能已由其他协程刷新
+            if not force and self._devices_data_fresh():
+                return
+            await self._with_reauth(lambda: self.client.get_devices_data())
+            self._devices_data_ts = time.monotonic()
+            self._index_litterboxes()
+
+    async def _on_request_end(self, session, ctx, params):
+        headers = params.response.headers
+        retry_after = headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            self._pause_until = max(self._pause_until, time.monotonic() + int(retry_after))
+            return
+        remaining, limit = headers.get("X-RateLimit-Remaining"), headers.get("X-RateLimit-Limit")
+        if remaining and limit and remaining.isdigit() and limit.isdigit() and int(remaining) < int(limit) * 0.1:
+            self._pause_until = max(self._pause_until, time.monotonic() + 1.0)
+
+    async def _acquire_rate_slot(self):
+        """等待直到最近 60 秒内的调用次数低于 PETKIT_RPM_LIMIT
+
+        锁内只计算并预约本次调用的发出时间，等待放在锁外，被限流的调用不会阻塞其他调用排队
+        """
+        async with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._pause_until)
+            if len(self._call_times) == self._call_times.maxlen:
+                start = max(start, self._call_times[0] + 60)
+            self._call_times.append(start)
+        wait = start - now
+        if wait > 0:
+            logger.warning(f"PetKit API 限流，等待 {wait:.1f}s 后发起调用")
+            await asyncio.sleep(wait)
+
+    async def _with_reauth(self, coro_factory, *, retries=1):
+        """执行 API 调用：会话过期或 401 时重新登录后重试，429 限流时指数退避后重试
+
+        coro_factory 每次重试都会重新调用，重新登录后会拿到新的 self.client
+        """
+        for attempt in range(retries + 1):
+            await self._acquire_rate_slot()
+            try:
+                return await coro_factory()
+            except (PetkitSessionExpiredError, PetkitAuthenticationError, PetkitInvalidHTTPResponseCodeError) as e:
+                status = _http_status(e) if isinstance(e, PetkitInvalidHTTPResponseCodeError) else None
+                expired = status == 401 or not isinstance(e, PetkitInvalidHTTPResponseCodeError)
+                if attempt >= retries or not (expired or status in _BACKOFF_STATUSES):
+                    raise
+                if expired:
+                    logger.warning("Session expired, attempting re-login...")
+                    if not await self._login():
+                        raise Exception("Re-login failed") from e
+                else:
+                    await asyncio.sleep(0.25 * 2 ** attempt)
+
     async def start(self):
         """Initialize the session and login - deprecated, use initialize() instead"""
         await self.initialize()
 
     async def close(self):
-        """Close the session"""
-        if self.session:
-            await self.session.close()
-            self.session = None
+        """Close the session (FastAPI lifespan 关闭时调用)，重复调用无副作用"""
+        # 等待尚未完成的会话写库
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        session, self.session = self.session, None
+        if session and not session.closed:
+            await session.close()
+
+    async def __aenter__(self):
+        await self.initialize()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     async def get_client_methods(self):
         if not self.client:
             await self.initialize()
 
-        try:
-            import pypetkitapi.command as cmd
-            constants = {k: v for k, v in vars(cmd).items() if not k.startswith('_')}
-        except ImportError:
-            constants = {"error": "Could not import pypetkitapi.command"}
+        # 客户端类型不会变化，方法列表只需计算一次
+        if self._client_methods is None:
+            self._client_methods = [m for m in dir(self.client) if not m.startswith('_')]
+        return {"methods": self._client_methods, "constants": _CMD_CONSTANTS}
 
-        return {"methods": [m for m in dir(self.client) if not m.startswith('_')], "constants": constants}
+    @property
+    def _devices_cache_key(self) -> str:
+        return f"petkit_devices:{self.username}"
 
     async def get_devices(self):
-        """Get all devices"""
+        """Get all devices（结果短时缓存，控制指令成功后失效）"""
+        cached = cache_manager.get(self._devices_cache_key)
+        if cached is not None:
+            return cached
+        devices = [d async for d in self.iter_devices()]
+        cache_manager.set(self._devices_cache_key, devices, ttl=PETKIT_DEVICES_TTL)
+        return devices
+
+    async def iter_devices(self):
+        """逐个产出设备，调用方按需消费，不必先构建完整列表"""
         if not self.client:
             await self.initialize()
 
-        try:
-            # 刷新数据
-            logger.info("正在刷新设备数据...")
-            await self.client.get_devices_data()
-            # 更新会话时间戳
-            await self._save_session_to_db()
-        except Exception as e:
-            if "Session expired" in str(e) or "401" in str(e):
-                logger.warning("Session expired, attempting re-login...")
-                if await self._login():
-                    await self.client.get_devices_data()
+        # 刷新数据
+        logger.debug("正在刷新设备数据...")
+        await self._refresh_devices()
+        # 更新会话时间戳
+        await self._save_session_to_db()
+
+        for entity in self.client.petkit_entities.values():
+            dev_data = self._build_device(entity)
+            if dev_data is not None:
+                yield dev_data
+
+    def _build_device(self, entity) -> Optional[Device]:
+        """把单个实体转换为 Device，宠物档案和未知设备类型返回 None"""
+        # 更准确的设备识别逻辑
+        # 1. 排除宠物档案 (有 pet_id)
+        if hasattr(entity, 'pet_id'):
+            return None
+
+        # 2. 获取标准化的设备类型，只处理已知的设备类型
+        dev_type = self._resolve_type(entity)
+        if dev_type not in _LITTERBOX_TYPES:
+            logger.debug("跳过未知设备类型: %s", dev_type)
+            return None
+
+        name = getattr(entity, 'name', 'Unknown')
+        logger.debug("处理实体: %s (类型: %s, ID: %s)", name, dev_type, entity.id)
+        dev_data = Device(
+            id=str(entity.id),
+            name=name,
+            type=dev_type,
+        )
+
+        # 尝试提取更多状态数据
+        raw_data = getattr(entity, 'data', None)
+        if raw_data:
+            # 确保 data 是字典，且值是基本类型
+            try:
+                if isinstance(raw_data, dict):
+                    # 简单过滤，防止包含复杂对象 (精确类型判断比 isinstance 更快)
+                    dev_data.data = {k: v for k, v in raw_data.items() if type(v) in _SCALAR_TYPES}
                 else:
-                    raise Exception("Re-login failed")
-            else:
-                raise e
-
-        devices = []
-        for dev_id, entity in self.client.petkit_entities.items():
-            # 更准确的设备识别逻辑
-            # 1. 排除宠物档案 (有 pet_id)
-            if hasattr(entity, 'pet_id'):
+                    dev_data.data = str(raw_data)
+            except:
+                dev_data.data = {}
+
+        # 提取设备状态信息
+        state_summary = {}
+        if hasattr(entity, 'state'):
+            state_obj = entity.state
+            for sattr, getter in _STATE_ATTR_GETTERS:
+                try:
+                    state_summary[sattr] = getter(state_obj)
+                except AttributeError:
+                    pass
+
+            # 直接读取状态对象 / 设备实体上的字段，不再序列化整个状态对象后用正则解析
+            found = False
+            for sattr, getters in _STATE_EXTRACTORS:
+                for getter in getters:
+                    try:
+                        val = getter(entity)
+                    except AttributeError:
+                        continue
+                    if val is not None:
+                        found = True
+                        state_summary[sattr] = val if type(val) in _SCALAR_TYPES else str(val)
+                        break
+
+            wifi = getattr(state_obj, 'wifi', None)
+            if wifi is not None and hasattr(wifi, 'rsq'):
+                state_summary['wifi_bssid'] = getattr(wifi, 'bssid', None)
+                state_summary['wifi_rsq'] = wifi.rsq
+
+            # 状态对象不是结构化对象时才退回字符串解析；原始字符串仅在调试开关打开时返回
+            if not found or PETKIT_RAW_STATE:
+                raw_state_str = str(state_obj)
+                if not found:
+                    self._extract_info_from_raw_state(raw_state_str, state_summary)
+                if PETKIT_RAW_STATE:
+                    state_summary['raw_state'] = raw_state_str
+
+        # 提取基础设备属性
+        entity_dict = getattr(entity, '__dict__', {})
+        data_dict = raw_data if isinstance(raw_data, dict) else {}
+        for attr in _INTERESTING:
+            # 上面状态提取已经取到的字段不再重复查找
+            if attr in state_summary:
                 continue
+            val = entity_dict.get(attr, data_dict.get(attr))
+            if val is not None:
+                state_summary[attr] = val if type(val) in _SCALAR_TYPES else str(val)
 
-            # 2. 通过 device_nfo 获取准确的设备类型
-            dev_type = 'Unknown'
-            if hasattr(entity, 'device_nfo') and hasattr(entity.device_nfo, 'device_type'):
-                dev_type = entity.device_nfo.device_type
-            else:
-                # 回退到原来的 device_type
-                dev_type = getattr(entity, 'device_type', 'Unknown')
-
-            # 3. 标准化设备类型名称
-            if dev_type.lower() == 't4':
-                dev_type = 'T4'
-            elif dev_type.lower() == 't3':
-                dev_type = 'T3'
-            elif dev_type.lower() == 't5':
-                dev_type = 'T5'
-
-            # 4. 只处理已知的设备类型
-            if dev_type not in ['T3', 'T4', 'T5']:
-                logger.info(f"跳过未知设备类型: {dev_type}")
-                continue
+        # 添加准确的统计信息
+        if hasattr(entity, 'device_stats'):
+            device_stats = entity.device_stats
+            state_summary['today_visits'] = getattr(device_stats, 'times', 0)
+            state_summary['avg_duration'] = getattr(device_stats, 'avg_time', 0)
+            state_summary['total_duration'] = getattr(device_stats, 'total_time', 0)
 
-            logger.info(f"处理实体: {getattr(entity, 'name', 'Unknown')} (类型: {dev_type}, ID: {entity.id})")
-            dev_data = {
-                "id": str(entity.id),
-                "name": getattr(entity, 'name', 'Unknown'),
-                "type": dev_type,
-                "data": {}
-            }
-
-            # 尝试提取更多状态数据
-            if hasattr(entity, 'data') and entity.data:
-                # 确保 data 是字典，且值是基本类型
-                try:
-                    raw_data = entity.data
-                    if isinstance(raw_data, dict):
-                        # 简单过滤，防止包含复杂对象
-                        dev_data["data"] = {k: v for k, v in raw_data.items() if isinstance(v, (str, int, float, bool, type(None)))}
-                    else:
-                        dev_data["data"] = str(raw_data)
-                except:
-                    dev_data["data"] = {}
-
-            # 提取设备状态信息
-            state_summary = {}
-            if hasattr(entity, 'state'):
-                state_obj = entity.state
-                known_state_attrs = ['box_full', 'liquid_lack', 'box_state', 'work_state', 'error_state']
-                for sattr in known_state_attrs:
-                    if hasattr(state_obj, sattr):
-                        state_summary[sattr] = getattr(state_obj, sattr)
-
-                # 从状态字符串提取额外信息
-                raw_state_str = str(state_obj)
-                state_summary['raw_state'] = raw_state_str
-                self._extract_info_from_raw_state(raw_state_str, state_summary)
-
-            # 提取基础设备属性
-            interesting_attrs = [
-                'liquid', 'weight', 'times', 'battery', 'connection',
-                'sand_percent', 'deodorant_left_days', 'used_times'
-            ]
-            for attr in interesting_attrs:
-                val = None
-                if hasattr(entity, attr):
-                    val = getattr(entity, attr)
-                elif hasattr(entity, 'data') and isinstance(entity.data, dict) and attr in entity.data:
-                    val = entity.data[attr]
-
-                if val is not None and isinstance(val, (str, int, float, bool)):
-                    state_summary[attr] = val
-                elif val is not None:
-                    state_summary[attr] = str(val)
-
-            # 添加准确的统计信息
-            if hasattr(entity, 'device_stats'):
-                device_stats = entity.device_stats
-                state_summary['today_visits'] = getattr(device_stats, 'times', 0)
-                state_summary['avg_duration'] = getattr(device_stats, 'avg_time', 0)
-                state_summary['total_duration'] = getattr(device_stats, 'total_time', 0)
-
-                # 获取最新的猫咪体重
-                if hasattr(device_stats, 'statistic_info') and device_stats.statistic_info:
-                    stat_info = device_stats.statistic_info
-                    if stat_info and len(stat_info) > 0:
-                        latest_record = stat_info[-1]
-                        latest_weight = getattr(latest_record, 'pet_weight', 0)
-                        if latest_weight > 0:
-                            state_summary['last_pet_weight'] = latest_weight / 1000.0
-
-            dev_data["state_summary"] = state_summary
-            devices.append(dev_data)
-        return devices
+            # 获取最新的猫咪体重
+            latest_weight = _latest_pet_weight_kg(device_stats)
+            if latest_weight is not None:
+                state_summary['last_pet_weight'] = latest_weight
+
+        dev_data.state_summary = state_summary
+        return dev_data
 
     async def clean_litterbox(self, device_id=None):
         """Trigger clean action for the first found or specified litterbox"""
         if not self.client:
             await self.initialize()
 
-        target_id = None
         # 如果未指定 ID，找第一个猫厕所 (T3/T4)
         if not device_id:
-            for dev_id, entity in self.client.petkit_entities.items():
-                target_type = self._get_device_type(entity)
-                if target_type in ['T3', 'T4', 'T5']:
-                    target_id = dev_id
-                    break
+            target_id, _ = self._first_litterbox()
         else:
             target_id = int(device_id) if str(device_id).isdigit() else device_id
 
         if target_id:
             logger.info(f"Sending clean command to {target_id}")
-            try:
-                from pypetkitapi.command import DeviceCommand, DeviceAction, LBCommand
-                await self.client.send_api_request(
-                    target_id,
-                    DeviceCommand.CONTROL_DEVICE,
-                    {DeviceAction.START: LBCommand.CLEANING}
-                )
-                # 更新会话时间戳
-                await self._save_session_to_db()
-                return {"status": "success", "device_id": str(target_id), "action": "clean"}
-            except Exception as e:
-                if "Session expired" in str(e) or "401" in str(e):
-                    logger.warning("Session expired during clean, re-logging in...")
-                    if await self._login():
-                        # Retry once
-                        await self.client.send_api_request(
-                            target_id,
-                            DeviceCommand.CONTROL_DEVICE,
-                            {DeviceAction.START: LBCommand.CLEANING}
-                        )
-                        await self._save_session_to_db()
-                        return {"status": "success", "device_id": str(target_id), "action": "clean"}
-                    else:
-                        raise Exception("Re-login failed")
-                raise e
+            await self._with_reauth(lambda: self.client.send_api_request(
+                target_id,
+                DeviceCommand.CONTROL_DEVICE,
+                {DeviceAction.START: LBCommand.CLEANING}
+            ))
+            # 更新会话时间戳
+            await self._save_session_to_db()
+            cache_manager.delete(self._devices_cache_key)
+            return {"status": "success", "device_id": str(target_id), "action": "clean"}
 
         raise Exception("No litterbox found or invalid device ID")
 
@@ -350,95 +586,78 @@ class PetKitService:
         if not self.client:
             await self.initialize()
 
-        target_id = None
-
         # 如果未指定 ID，找第一个猫厕所 (T3/T4)
         if not device_id:
-            for dev_id, entity in self.client.petkit_entities.items():
-                target_type = self._get_device_type(entity)
-                if target_type in ['T3', 'T4', 'T5']:
-                    target_id = dev_id
-                    break
+            target_id, _ = self._first_litterbox()
         else:
             target_id = int(device_id) if str(device_id).isdigit() else device_id
 
         if target_id:
             logger.info(f"Sending deodorize command to {target_id}")
-            try:
-                from pypetkitapi.command import LitterCommand, DeviceAction, LBCommand
-                # 发送除臭指令 (DESODORIZE / SPRAY)
-                await self.client.send_api_request(
-                    target_id,
-                    LitterCommand.CONTROL_DEVICE,
-                    {DeviceAction.START: LBCommand.DESODORIZE}
-                )
-                # 更新会话时间戳
-                await self._save_session_to_db()
-                return {"status": "success", "device_id": str(target_id), "action": "deodorize"}
-            except Exception as e:
-                if "Session expired" in str(e) or "401" in str(e):
-                    logger.warning("Session expired during deodorize, re-logging in...")
-                    if await self._login():
-                        # Retry once
-                        await self.client.send_api_request(
-                            target_id,
-                            LitterCommand.CONTROL_DEVICE,
-                            {DeviceAction.START: LBCommand.DESODORIZE}
-                        )
-                        await self._save_session_to_db()
-                        return {"status": "success", "device_id": str(target_id), "action": "deodorize"}
-                    else:
-                        raise Exception("Re-login failed")
-                raise e
+            # 发送除臭指令 (DESODORIZE / SPRAY)
+            await self._with_reauth(lambda: self.client.send_api_request(
+                target_id,
+                LitterCommand.CONTROL_DEVICE,
+                {DeviceAction.START: LBCommand.DESODORIZE}
+            ))
+            # 更新会话时间戳
+            await self._save_session_to_db()
+            cache_manager.delete(self._devices_cache_key)
+            return {"status": "success", "device_id": str(target_id), "action": "deodorize"}
 
         raise Exception("No litterbox found or invalid device ID")
 
-    def _get_device_type(self, entity):
-        """获取设备类型"""
-        target_type = 'Unknown'
-        if hasattr(entity, 'device_nfo') and hasattr(entity.device_nfo, 'device_type'):
-            target_type = entity.device_nfo.device_type.upper()
-        else:
-            target_type = getattr(entity, 'device_type', '').upper()
+    def _resolve_type(self, entity) -> str:
+        """获取标准化 (大写) 的设备类型，按实体 ID 缓存"""
+        entity_id = getattr(entity, 'id', None)
+        cached = self._device_type_cache.get(entity_id)
+        if cached is not None:
+            return cached
+
+        # 通过 device_nfo 获取准确的设备类型，回退到原来的 device_type
+        raw_type = (getattr(getattr(entity, 'device_nfo', None), 'device_type', None)
+                    or getattr(entity, 'device_type', None) or 'Unknown')
+        target_type = _TYPE_NORMALIZE.get(raw_type) or str(raw_type).upper()
 
         # 兼容之前的逻辑
-        if target_type == 'UNKNOWN' and hasattr(entity, 'name') and ('MAX' in entity.name or '猫厕所' in entity.name):
-            target_type = 'T4'
+        if target_type == 'UNKNOWN':
+            name = getattr(entity, 'name', None) or ''
+            if any(hint in name for hint in _LITTERBOX_NAME_HINTS):
+                target_type = 'T4'
 
+        if entity_id is not None:
+            self._device_type_cache[entity_id] = target_type
         return target_type
 
-    def _extract_info_from_raw_state(self, raw_state: str, state_summary: dict):
-        """从原始状态字符串中提取关键信息"""
-        # 定义要提取的关键字段
-        key_fields = [
-            'deodorant_left_days', 'sand_percent', 'sand_weight',
-            'used_times', 'frequent_restroom', 'liquid_lack',
-            'box_full', 'sand_lack', 'power', 'ota'
+    def _index_litterboxes(self):
+        """设备数据刷新后重建猫厕所索引，同时预先解析并缓存所有实体的设备类型"""
+        self._litterbox_ids = [
+            dev_id for dev_id, entity in self.client.petkit_entities.items()
+            if self._resolve_type(entity) in _LITTERBOX_TYPES
         ]
 
-        # 使用正则表达式提取字段值
-        import re
-        for field in key_fields:
-            # 匹配 pattern: field=value 或 field=value,
-            pattern = rf'{field}=([\w\d\.-]+)'
-            match = re.search(pattern, raw_state)
-            if match:
-                value = match.group(1)
-                # 尝试转换为适当的类型
-                try:
-                    if value.lower() in ['true', 'false']:
-                        state_summary[field] = value.lower() == 'true'
-                    elif '.' in value:
-                        state_summary[field] = float(value)
-                    elif value.isdigit() or (value.startswith('-') and value[1:].isdigit()):
-                        state_summary[field] = int(value)
-                    else:
-                        state_summary[field] = value
-                except:
-                    state_summary[field] = value
+    def _first_litterbox(self):
+        """返回第一个猫厕所的 (设备ID, 实体)，没有时返回 (None, None)"""
+        entities = self.client.petkit_entities
+        for dev_id in self._litterbox_ids:
+            entity = entities.get(dev_id)
+            if entity is not None:
+                return dev_id, entity
+        return None, None
+
+    def _extract_info_from_raw_state(self, raw_state: str, state_summary: dict):
+        """从原始状态字符串中提取关键信息"""
+        # 单次扫描提取所有关键字段，同名字段以首次出现为准
+        seen = set()
+        for match in _RAW_STATE_KV_RE.finditer(raw_state):
+            field, value = match.group(1), match.group(2)
+            if field in seen:
+                continue
+            seen.add(field)
+            state_summary[field] = _coerce_state_value(value)
 
         # 特殊处理wifi信息
-        wifi_match = re.search(r'wifi=Wifi\(bssid=\'(.*?)\', rsq=(-?\d+)', raw_state)
+        wifi_match = _RAW_STATE_WIFI_RE.search(raw_state)
         if wifi_match:
             state_summary['wifi_bssid'] = wifi_match.group(1)
             state_summary['wifi_rsq'] = int(wifi_match.group(2))
@@ -449,25 +668,13 @@ class PetKitService:
             await self.initialize()
 
         # 刷新设备数据，这会自动调用统计任务
-        await self.client.get_devices_data()
-
-        target_entity = None
+        await self._refresh_devices()
 
         if device_id:
             target_entity = self.client.petkit_entities.get(int(device_id))
         else:
             # 找第一个猫厕所
-            for entity in self.client.petkit_entities.values():
-                # 使用改进的设备类型识别
-                dev_type = 'Unknown'
-                if hasattr(entity, 'device_nfo') and hasattr(entity.device_nfo, 'device_type'):
-                    dev_type = entity.device_nfo.device_type.upper()
-                else:
-                    dev_type = getattr(entity, 'device_type', '').upper()
-
-                if dev_type in ['T3', 'T4', 'T5']:
-                    target_entity = entity
-                    break
+            _, target_entity = self._first_litterbox()
 
         if not target_entity:
             return {"error": "未找到设备"}
@@ -508,25 +715,13 @@ class PetKitService:
             await self.initialize()
 
         # 刷新设备数据，确保统计信息是最新的
-        await self.client.get_devices_data()
-
-        target_entity = None
+        await self._refresh_devices()
 
         if device_id:
             target_entity = self.client.petkit_entities.get(int(device_id))
         else:
             # 找第一个猫厕所
-            for entity in self.client.petkit_entities.values():
-                # 使用改进的设备类型识别
-                dev_type = 'Unknown'
-                if hasattr(entity, 'device_nfo') and hasattr(entity.device_nfo, 'device_type'):
-                    dev_type = entity.device_nfo.device_type.upper()
-                else:
-                    dev_type = getattr(entity, 'device_type', '').upper()
-
-                if dev_type in ['T3', 'T4', 'T5']:
-                    target_entity = entity
-                    break
+            _, target_entity = self._first_litterbox()
 
         if target_entity:
             try:
@@ -548,18 +743,13 @@ class PetKitService:
                     })
 
                     # 获取详细的宠物统计信息
-                    if hasattr(device_stats, 'statistic_info'):
-                        stat_info = device_stats.statistic_info
-                        if stat_info and len(stat_info) > 0:
-                            # 获取最新的记录
-                            latest_record = stat_info[-1]
-                            result["last_visit"] = str(getattr(latest_record, 'statistic_date', 'N/A'))
-                            # 获取最新的猫咪体重
-                            latest_weight = getattr(latest_record, 'pet_weight', 0)
-                            if latest_weight > 0:
-                                result["last_pet_weight"] = latest_weight / 1000.0  # 转换为kg
-                        else:
-                            result["last_visit"] = "N/A"
+                    latest_record = _latest_stat_record(device_stats)
+                    if latest_record is not None:
+                        result["last_visit"] = str(getattr(latest_record, 'statistic_date', 'N/A'))
+                        # 获取最新的猫咪体重（kg）
+                        latest_weight = _latest_pet_weight_kg(device_stats)
+                        if latest_weight is not None:
+                            result["last_pet_weight"] = latest_weight
                     else:
                         result["last_visit"] = "N/A"
 
@@ -1,6 +1,7 @@
 import asyncio
+import heapq
 import time
-from typing import Any, Dict, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 from collections import OrderedDict
 
 
@@ -8,30 +9,21 @@ class CacheManager:
     """简单的内存缓存管理器，支持过期时间和LRU淘汰"""
     
     def __init__(self, max_size: int = 1000):
-        self._cache: Dict[str, tuple] = {}  # key -> (value, expire_time, access_time)
+        # key -> (value, expire_time)，OrderedDict 的顺序即 LRU 顺序（末尾为最近访问）
+        self._cache: OrderedDict[str, Tuple[Any, Optional[float]]] = OrderedDict()
         self._max_size = max_size
-        self._access_order = OrderedDict()  # 用于LRU
+        # (expire_time, key) 最小堆；覆盖或删除后留下的旧条目在出堆时按过期时间比对丢弃
+        self._expiry_heap: List[Tuple[float, str]] = []
     
     def _cleanup_expired(self):
-        """清理过期的缓存项"""
-        current_time = time.time()
-        expired_keys = []
-        
-        for key, (value, expire_time, access_time) in self._cache.items():
-            if expire_time and current_time > expire_time:
-                expired_keys.append(key)
-        
-        for key in expired_keys:
-            del self._cache[key]
-            if key in self._access_order:
-                del self._access_order[key]
-    
-    def _evict_lru(self):
-        """LRU淘汰策略"""
-        if len(self._cache) >= self._max_size:
-            # 移除最久未访问的项
-            lru_key = self._access_order.popitem(last=False)[0]
-            del self._cache[lru_key]
+        """清理过期的缓存项，只检查堆顶已到期的条目"""
+        current_time = time.monotonic()
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= current_time:
+            expire_time, key = heapq.heappop(heap)
+            entry = self._cache.get(key)
+            if entry is not None and entry[1] == expire_time:
+                del self._cache[key]
     
     def set(self, key: str, value: Any, ttl: Optional[int] = None):
         """设置缓存项
@@ -41,45 +33,51 @@ class CacheManager:
             value: 缓存值
             ttl: 过期时间（秒），None表示永不过期
         """
-        current_time = time.time()
-        expire_time = current_time + ttl if ttl else None
-        
-        # 如果已经存在，更新访问顺序
-        if key in self._cache:
-            del self._access_order[key]
-        
-        # LRU淘汰
-        self._evict_lru()
-        
-        self._cache[key] = (value, expire_time, current_time)
-        self._access_order[key] = current_time
+        expire_time = time.monotonic() + ttl if ttl else None
+        self._cache.pop(key, None)
+        self._cache[key] = (value, expire_time)
+        # 超出容量时移除最久未访问的项（LRU）
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+        if expire_time:
+            heapq.heappush(self._expiry_heap, (expire_time, key))
     
     def get(self, key: str) -> Optional[Any]:
-        """获取缓存项"""
-        self._cleanup_expired()
-        
-        if key in self._cache:
-            value, expire_time, access_time = self._cache[key]
-            current_time = time.time()
-            
-            # 更新访问时间
-            self._access_order.move_to_end(key)
-            self._cache[key] = (value, expire_time, current_time)
-            
-            return value
-        return None
+        """获取缓存项，过期项在访问时删除"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        value, expire_time = entry
+        if expire_time and time.monotonic() > expire_time:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return value
+    
+    def mget(self, keys: List[str]) -> Dict[str, Optional[Any]]:
+        """批量获取缓存项，未命中的键对应 None"""
+        return {key: self.get(key) for key in keys}
+    
+    def mset(self, items: Dict[str, Any], ttl: Optional[int] = None):
+        """批量设置缓存项，所有项共用同一个过期时间，写完后统一做一次 LRU 淘汰"""
+        expire_time = time.monotonic() + ttl if ttl else None
+        cache = self._cache
+        for key, value in items.items():
+            cache.pop(key, None)
+            cache[key] = (value, expire_time)
+            if expire_time:
+                heapq.heappush(self._expiry_heap, (expire_time, key))
+        while len(cache) > self._max_size:
+            cache.popitem(last=False)
     
     def delete(self, key: str):
         """删除缓存项"""
-        if key in self._cache:
-            del self._cache[key]
-        if key in self._access_order:
-            del self._access_order[key]
+        self._cache.pop(key, None)
     
     def clear(self):
         """清空所有缓存"""
         self._cache.clear()
-        self._access_order.clear()
+        self._expiry_heap.clear()
     
     def exists(self, key: str) -> bool:
         """检查键是否存在且未过期"""
@@ -96,92 +94,188 @@ class CacheManager:
 cache_manager = CacheManager(max_size=1000)
 
 
+class SingleFlight:
+    """按键合并并发回源：同一个键同一时刻只有一个回源任务，其余协程等待同一个结果
+
+    只保存进行中的任务，任务结束即从字典中移除，键的数量不会无限增长。
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+    
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # shield: 单个等待方被取消时不影响其他协程共享的回源任务
+        return await asyncio.shield(task)
+    
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+
 class AsyncCacheManager:
-    """异步版本的缓存管理器"""
+    """异步版本的缓存管理器
+
+    只在单进程、单事件循环内使用：读取路径中间没有 await，不会与其他协程交错，因此不加锁；
+    锁只用于写入和清理。
+    """
     
     def __init__(self, max_size: int = 1000):
-        self._cache: Dict[str, tuple] = {}
+        # key -> (value, expire_time)，OrderedDict 的顺序即 LRU 顺序（末尾为最近访问）
+        self._cache: OrderedDict[str, Tuple[Any, Optional[float]]] = OrderedDict()
         self._max_size = max_size
-        self._access_order = OrderedDict()
+        self._expiry_heap: List[Tuple[float, str]] = []
         self._lock = asyncio.Lock()
+        self._single_flight = SingleFlight()
+        self._sweeper: Optional[asyncio.Task] = None
     
     async def _cleanup_expired(self):
-        """异步清理过期项（不在锁内执行）"""
-        current_time = time.time()
-        expired_keys = []
-        
-        # 先收集过期的键（不需要锁）
-        for key, (value, expire_time, access_time) in self._cache.items():
-            if expire_time and current_time > expire_time:
-                expired_keys.append(key)
-        
-        # 然后在锁内删除
-        if expired_keys:
-            async with self._lock:
-                for key in expired_keys:
-                    if key in self._cache:
-                        del self._cache[key]
-                    if key in self._access_order:
-                        del self._access_order[key]
-    
-    async def _evict_lru(self):
-        """异步LRU淘汰（不在锁内判断）"""
-        if len(self._cache) >= self._max_size:
-            async with self._lock:
-                # 再次检查，因为可能在等待锁期间已经有变化
-                if len(self._cache) >= self._max_size and self._access_order:
-                    lru_key = self._access_order.popitem(last=False)[0]
-                    if lru_key in self._cache:
-                        del self._cache[lru_key]
+        """异步清理过期项：堆顶未到期时不加锁直接返回"""
+        heap = self._expiry_heap
+        if not heap or heap[0][0] > time.monotonic():
+            return
+        async with self._lock:
+            current_time = time.monotonic()
+            while heap and heap[0][0] <= current_time:
+                expire_time, key = heapq.heappop(heap)
+                entry = self._cache.get(key)
+                if entry is not None and entry[1] == expire_time:
+                    del self._cache[key]
+    
+    async def _sweep_loop(self, interval: float):
+        """后台清理过期项：睡到最近的过期时间（最长 interval 秒）后清理一次"""
+        while True:
+            heap = self._expiry_heap
+            delay = min(interval, max(heap[0][0] - time.monotonic(), 0)) if heap else interval
+            await asyncio.sleep(delay)
+            await self._cleanup_expired()
+    
+    def start_sweeper(self, interval: float = 60):
+        """启动后台清理任务，需在事件循环内调用"""
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop(interval))
+    
+    async def stop_sweeper(self):
+        """停止后台清理任务"""
+        sweeper, self._sweeper = self._sweeper, None
+        if sweeper:
+            sweeper.cancel()
+            await asyncio.gather(sweeper, return_exceptions=True)
+    
+    def _get_entry(self, key: str, current_time: float) -> Optional[Any]:
+        """读取并刷新 LRU 顺序，惰性删除过期项；同步执行，无需持有锁"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        value, expire_time = entry
+        if expire_time and current_time > expire_time:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return value
     
     async def set(self, key: str, value: Any, ttl: Optional[int] = None):
-        """异步设置缓存"""
-        await self._cleanup_expired()
+        """异步设置缓存（过期项由后台任务或读取时清理）"""
         async with self._lock:
-            current_time = time.time()
-            expire_time = current_time + ttl if ttl else None
-            
-            if key in self._cache:
-                del self._access_order[key]
-            
-            await self._evict_lru()
-            
-            self._cache[key] = (value, expire_time, current_time)
-            self._access_order[key] = current_time
+            expire_time = time.monotonic() + ttl if ttl else None
+            self._cache.pop(key, None)
+            self._cache[key] = (value, expire_time)
+            if len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+            if expire_time:
+                heapq.heappush(self._expiry_heap, (expire_time, key))
     
     async def get(self, key: str) -> Optional[Any]:
-        """异步获取缓存"""
-        await self._cleanup_expired()
+        """异步获取缓存（无锁快速路径）"""
+        return self._get_entry(key, time.monotonic())
+    
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: Optional[int] = None) -> Any:
+        """获取缓存，未命中时调用 loader 回源并写入缓存
+        
+        同一个键的并发未命中只会回源一次（防止缓存击穿），loader 抛出的异常不会被缓存
+        """
+        value = await self.get(key)
+        if value:
+            return value
+        
+        async def load():
+            value = await loader()
+            await self.set(key, value, ttl=ttl)
+            return value
+        
+        return await self._single_flight.do(key, load)
+    
+    async def mget(self, keys: List[str]) -> Dict[str, Optional[Any]]:
+        """批量获取缓存
+
+        Returns:
+            key -> value 映射，未命中的键对应 None
+        """
+        current_time = time.monotonic()
+        return {key: self._get_entry(key, current_time) for key in keys}
+    
+    async def mset(self, items: Dict[str, Any], ttl: Optional[int] = None):
+        """批量设置缓存，只加锁一次，写完后统一做一次 LRU 淘汰"""
         async with self._lock:
-            if key in self._cache:
-                value, expire_time, access_time = self._cache[key]
-                current_time = time.time()
-                
-                self._access_order.move_to_end(key)
-                self._cache[key] = (value, expire_time, current_time)
-                
-                return value
-            return None
+            expire_time = time.monotonic() + ttl if ttl else None
+            cache = self._cache
+            for key, value in items.items():
+                cache.pop(key, None)
+                cache[key] = (value, expire_time)
+                if expire_time:
+                    heapq.heappush(self._expiry_heap, (expire_time, key))
+            while len(cache) > self._max_size:
+                cache.popitem(last=False)
+    
+    async def touch(self, key: str, ttl: Optional[int] = None) -> bool:
+        """只刷新已有键的过期时间，不替换值
+
+        Returns:
+            键存在且未过期时返回 True
+        """
+        async with self._lock:
+            current_time = time.monotonic()
+            entry = self._cache.get(key)
+            if entry is None or (entry[1] and current_time > entry[1]):
+                self._cache.pop(key, None)
+                return False
+            expire_time = current_time + ttl if ttl else None
+            self._cache[key] = (entry[0], expire_time)
+            self._cache.move_to_end(key)
+            if expire_time:
+                heapq.heappush(self._expiry_heap, (expire_time, key))
+            return True
     
     async def delete(self, key: str):
         """异步删除缓存"""
         async with self._lock:
-            if key in self._cache:
-                del self._cache[key]
-            if key in self._access_order:
-                del self._access_order[key]
+            self._cache.pop(key, None)
     
     async def clear(self):
         """异步清空缓存"""
         async with self._lock:
             self._cache.clear()
-            self._access_order.clear()
+            self._expiry_heap.clear()
     
     async def exists(self, key: str) -> bool:
-        """异步检查键是否存在"""
-        await self._cleanup_expired()
+        """异步检查键是否存在且未过期"""
         async with self._lock:
-            return key in self._cache
+            entry = self._cache.get(key)
+            if entry is None:
+                return False
+            if entry[1] and time.monotonic() > entry[1]:
+                del self._cache[key]
+                return False
+            return True
+    
+    async def size(self) -> int:
+        """返回当前缓存大小（不含已过期项）"""
+        await self._cleanup_expired()
+        return len(self._cache)
 
 
 # 异步缓存实例
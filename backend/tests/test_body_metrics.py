@@ -0,0 +1,27 @@
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.main import calculate_body_metrics, calculate_body_metrics_batch  # noqa: E402
+from app.models.models import User  # noqa: E402
+
+
+def test_batch_matches_scalar_calculation():
+    rng = random.Random(0)
+    weights, impedances, users = [], [], []
+    for _ in range(5000):
+        weights.append(round(rng.uniform(30.0, 150.0), 2))
+        impedances.append(rng.choice([0, rng.randint(300, 900)]))
+        users.append(User(
+            name="u",
+            gender=rng.choice(["male", "female"]),
+            age=rng.randint(10, 90),
+            height=rng.randint(140, 200),
+        ))
+
+    batch = calculate_body_metrics_batch(weights, impedances, users)
+
+    expected = [calculate_body_metrics(w, i, u) for w, i, u in zip(weights, impedances, users)]
+    assert batch == expected
@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+import orjson
+from pypetkitapi.litter_container import WorkState
+from starlette.requests import Request
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.main import cached_json_response  # noqa: E402
+from app.services.petkit_service import Device  # noqa: E402
+
+
+def _request(headers=()):
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": list(headers)})
+
+
+def test_device_with_nested_state_model_serializes():
+    device = Device(
+        id="1",
+        name="MAX",
+        type="T4",
+        state_summary={"work_state": WorkState(workMode=0, workProcess=10)},
+    )
+
+    response = cached_json_response(_request(), [device])
+
+    assert response.status_code == 200
+    body = orjson.loads(response.body)
+    assert body[0]["state_summary"]["work_state"]["workMode"] == 0
+    assert body[0]["state_summary"]["work_state"]["workProcess"] == 10
+
+
+def test_matching_etag_returns_304():
+    device = Device(id="1", name="MAX", type="T4", state_summary={"work_state": WorkState(workMode=1)})
+    etag = cached_json_response(_request(), [device]).headers["etag"]
+
+    response = cached_json_response(_request([(b"if-none-match", etag.encode())]), [device])
+
+    assert response.status_code == 304
+
+
+def test_responses_must_be_revalidated():
+    response = cached_json_response(_request(), {"ok": True})
+
+    assert response.headers["cache-control"] == "private, no-cache"
@@ -0,0 +1,82 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import aiohttp
+from pypetkitapi.exceptions import PetkitInvalidHTTPResponseCodeError
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.services.petkit_service import PetKitService  # noqa: E402
+
+
+def _wrapped_http_error(status):
+    """按 pypetkitapi _handle_response 的方式包装 HTTP 错误"""
+    try:
+        try:
+            raise aiohttp.ClientResponseError(request_info=None, history=(), status=status)
+        except aiohttp.ClientResponseError as e:
+            raise PetkitInvalidHTTPResponseCodeError(f"Request failed with status code {e.status}") from e
+    except PetkitInvalidHTTPResponseCodeError as wrapped:
+        return wrapped
+
+
+class FakeClient:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def get_devices_data(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def _service(client):
+    service = PetKitService("user", "pass")
+    service.client = client
+    service.logins = 0
+
+    async def fake_login():
+        service.logins += 1
+        return True
+
+    service._login = fake_login
+    return service
+
+
+def test_wrapped_401_triggers_relogin_and_retry():
+    client = FakeClient([_wrapped_http_error(401)])
+    service = _service(client)
+
+    result = asyncio.run(service._with_reauth(lambda: service.client.get_devices_data()))
+
+    assert result == "ok"
+    assert service.logins == 1
+    assert client.calls == 2
+
+
+def test_other_http_errors_are_not_retried():
+    client = FakeClient([_wrapped_http_error(404)])
+    service = _service(client)
+
+    try:
+        asyncio.run(service._with_reauth(lambda: service.client.get_devices_data()))
+    except PetkitInvalidHTTPResponseCodeError:
+        pass
+    else:
+        raise AssertionError("expected PetkitInvalidHTTPResponseCodeError")
+    assert service.logins == 0
+    assert client.calls == 1
+
+
+def test_wrapped_429_backs_off_and_retries_without_relogin():
+    client = FakeClient([_wrapped_http_error(429)])
+    service = _service(client)
+
+    result = asyncio.run(service._with_reauth(lambda: service.client.get_devices_data()))
+
+    assert result == "ok"
+    assert service.logins == 0
+    assert client.calls == 2
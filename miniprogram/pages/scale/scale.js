@@ -1,6 +1,12 @@
 const app = getApp();
 const bleUtils = require('../../utils/ble_scale.js');
 
+// 广播回调只缓存原始帧，每 100ms 批量解析一次
+const DRAIN_INTERVAL = 100;
+const MAX_PENDING = 32;
+// 体脂秤广播名匹配规则，每个回调只做一次正则测试
+const SCALE_NAME_RE = /MI Scale|Body/;
+
 Page({
   data: {
     scanning: false,
@@ -14,6 +20,9 @@ Page({
   },
 
   onLoad() {
+    this._pending = new Map();  // deviceId -> 最新一帧广播
+    this._lastFrames = {};      // deviceId -> 上次解析过的帧内容
+    this._drainTimer = null;
     this.fetchUsers()
   },
 
@@ -38,6 +47,7 @@ Page({
           allowDuplicatesKey: true,
           success: (res) => {
             this.log("开始扫描");
+            this._drainTimer = setInterval(() => this.drainPending(), DRAIN_INTERVAL);
             wx.onBluetoothDeviceFound(this.onDeviceFound);
           }
         });
@@ -50,6 +60,11 @@ Page({
   },
 
   stopScan() {
+    if (this._drainTimer) {
+      clearInterval(this._drainTimer);
+      this._drainTimer = null;
+    }
+    this._pending.clear();
     wx.stopBluetoothDevicesDiscovery();
     wx.closeBluetoothAdapter();
     this.setData({ scanning: false });
@@ -58,21 +73,36 @@ Page({
 
   onDeviceFound(res) {
     res.devices.forEach(device => {
-      if (device.name && (device.name.includes("MI Scale") || device.name.includes("Body"))) {
-        const manufacturerData = device.advertisData;
-        if (manufacturerData) {
-          const result = bleUtils.parseScaleData(manufacturerData);
-          if (result) {
-            this.setData({
-              device: device.name,
-              weight: result.weight,
-              isStabilized: result.isStabilized
-            });
-            
-            if (result.isStabilized) {
-               this.log(`稳定体重 ${result.weight}kg`);
-            }
-          }
+      if (device.advertisData && device.name && SCALE_NAME_RE.test(device.name)) {
+        // 同一设备只保留最新一帧，缓冲区已满时丢弃新设备
+        if (this._pending.size < MAX_PENDING || this._pending.has(device.deviceId)) {
+          this._pending.set(device.deviceId, device);
+        }
+      }
+    });
+  },
+
+  drainPending() {
+    if (this._pending.size === 0) return;
+    const devices = Array.from(this._pending.values());
+    this._pending.clear();
+
+    devices.forEach(device => {
+      // 秤会重复广播相同的数据，内容未变化时跳过解析和 setData
+      const frame = Array.prototype.join.call(new Uint8Array(device.advertisData));
+      if (this._lastFrames[device.deviceId] === frame) return;
+      this._lastFrames[device.deviceId] = frame;
+
+      const result = bleUtils.parseScaleData(device.advertisData);
+      if (result) {
+        this.setData({
+          device: device.name,
+          weight: result.weight,
+          isStabilized: result.isStabilized
+        });
+        
+        if (result.isStabilized) {
+           this.log(`稳定体重 ${result.weight}kg`);
         }
       }
     });
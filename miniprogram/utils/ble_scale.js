@@ -6,15 +6,16 @@
  * @param {ArrayBuffer} buffer - 蓝牙广播数据
  */
 function parseScaleData(buffer) {
-  const data = new Uint8Array(buffer);
+  if (buffer.byteLength < 13) return null;
+  const view = new DataView(buffer);
   
   // 简单校验（实际协议可能更复杂，这里仅作体重解析示例）
   // 假设 Service Data 符合小米协议
   // 字节序通常是 Little Endian
   
   // 提取控制位 (Byte 0 & 1)
-  const ctrlByte0 = data[0];
-  const ctrlByte1 = data[1];
+  const ctrlByte0 = view.getUint8(0);
+  const ctrlByte1 = view.getUint8(1);
   
   const isStabilized = (ctrlByte1 & 0x20) !== 0; // 是否稳定
   const isLbs = (ctrlByte0 & 0x01) !== 0; // 是否为磅
@@ -35,9 +36,7 @@ function parseScaleData(buffer) {
   
   // 这里假设是 Mi Body Composition Scale 2 的格式
   // 体重在 11-12 字节 (Little Endian)
-  if (data.length < 13) return null;
-  
-  let weight = (data[12] << 8) | data[11];
+  let weight = view.getUint16(11, true);
   
   // 单位转换
   if (isCatty) {
@@ -54,7 +53,7 @@ function parseScaleData(buffer) {
   }
   
   // 阻抗
-  let impedance = (data[10] << 8) | data[9];
+  let impedance = view.getUint16(9, true);
   
   return {
     weight: parseFloat(weight.toFixed(2)),